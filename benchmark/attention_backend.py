@@ -0,0 +1,102 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent_dir)
+
+import src.ddim_v_hacked as ddim_v_hacked  # noqa: E402
+
+
+def make_inputs(args, device, dtype):
+    # The self-attention of the first up blocks of SD 1.5. With keepstyle the
+    # contexts of the first and the previous frame are concatenated.
+    torch.manual_seed(0)
+    n_query = (args.resolution // 8)**2
+    n_key = n_query * (2 if args.keepstyle else 1)
+    bh = args.batch_size * args.heads
+    q = torch.randn(bh, n_query, args.dim_head, device=device, dtype=dtype)
+    k = torch.randn(bh, n_key, args.dim_head, device=device, dtype=dtype)
+    v = torch.randn(bh, n_key, args.dim_head, device=device, dtype=dtype)
+    mask = torch.rand(bh, 1, n_key, device=device) > 0.1
+    return q, k, v, mask
+
+
+def run(attention, inputs, scale, mask, n_iter, device):
+    q, k, v, attn_mask = inputs
+    if not mask:
+        attn_mask = None
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base_memory = torch.cuda.memory_allocated() if device.type == 'cuda' \
+        else 0
+    times = []
+    for _ in range(n_iter):
+        beg = time.time()
+        out = attention(q, k, v, scale, attn_mask)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.time() - beg)
+    peak_memory = torch.cuda.max_memory_allocated() - base_memory \
+        if device.type == 'cuda' else None
+    return out, times, peak_memory
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    dtype = torch.float16 if args.fp16 else torch.float32
+    inputs = make_inputs(args, device, dtype)
+    scale = args.dim_head**-0.5
+    print(f'q: {list(inputs[0].shape)}, k/v: {list(inputs[1].shape)}, '
+          f'{dtype}, {device}, ATTN_PRECISION '
+          f'{ddim_v_hacked._ATTN_PRECISION}')
+    for mask in [False, True]:
+        ref = None
+        for backend in ['einsum'] + args.backends:
+            attention = ddim_v_hacked.get_attention_backend(backend)
+            out, times, peak_memory = run(attention, inputs, scale, mask,
+                                          args.n_iter, device)
+            if ref is None:
+                ref = out.float()
+            diff = (out.float() - ref).abs().max().item()
+            memory = 'n/a' if peak_memory is None else \
+                f'{peak_memory / 2**20:.0f} MB'
+            print(f'mask {mask}, {backend}: '
+                  f'{min(times) * 1000:.1f} ms, peak memory {memory}, '
+                  f'max diff to einsum {diff:.2e}')
+            if diff > args.tol:
+                raise RuntimeError(f'{backend} differs from einsum by {diff}')
+            del out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device',
+                        type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--resolution', type=int, default=512)
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=2,
+                        help='2 for cond and uncond')
+    parser.add_argument('--heads', type=int, default=8)
+    parser.add_argument('--dim_head', type=int, default=40)
+    parser.add_argument('--no_keepstyle',
+                        dest='keepstyle',
+                        action='store_false',
+                        help='Do not double the keys as keepstyle does')
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--n_iter', type=int, default=3)
+    parser.add_argument('--tol', type=float, default=1e-3)
+    parser.add_argument('--backends',
+                        type=str,
+                        nargs='+',
+                        default=['sliced', 'sdpa'],
+                        choices=ddim_v_hacked.ATTN_BACKENDS)
+    args = parser.parse_args()
+    main(args)
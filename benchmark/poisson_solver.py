@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent_dir)
+
+import blender.poisson_fusion as poisson_fusion  # noqa: E402
+
+
+def make_frames(n_frame, h, w, seed=0):
+    # Smooth random images so that the blending problem looks like a real one
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(n_frame):
+        imgs = []
+        for _ in range(3):
+            img = rng.uniform(0, 255, (h // 16 + 1, w // 16 + 1, 3))
+            img = cv2.resize(img, (w, h), interpolation=cv2.INTER_CUBIC)
+            imgs.append(np.clip(img, 0, 255).astype(np.uint8))
+        mask = (rng.uniform(0, 1, (h // 32 + 1, w // 32 + 1)) > 0.5)
+        mask = cv2.resize(mask.astype(np.uint8), (w, h),
+                          interpolation=cv2.INTER_NEAREST)
+        frames.append((*imgs, mask))
+    return frames
+
+
+def run(frames, solver):
+    poisson_fusion.As = None
+    poisson_fusion.prev_states = None
+    results = []
+    times = []
+    for blendI, I1, I2, mask in frames:
+        beg = time.time()
+        results.append(
+            poisson_fusion.poisson_fusion(blendI, I1, I2, mask, solver=solver))
+        times.append(time.time() - beg)
+    return results, times
+
+
+def main(args):
+    poisson_fusion.A_CACHE_DIR = None
+    frames = make_frames(args.n_frame, args.height, args.width)
+    ref, ref_times = run(frames, 'lsqr')
+    print(f'Frame size: {args.height}x{args.width}, {args.n_frame} frames')
+    print(f'lsqr: {np.mean(ref_times):.3f} s/frame')
+    for solver in args.solvers:
+        res, times = run(frames, solver)
+        diff = np.stack([
+            np.abs(x.astype(np.int16) - y.astype(np.int16))
+            for x, y in zip(res, ref)
+        ])
+        print(f'{solver}: first frame {times[0]:.3f} s, '
+              f'following frames {np.mean(times[1:]):.3f} s/frame, '
+              f'max diff {diff.max()}, mean diff {diff.mean():.4f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=896)
+    parser.add_argument('--n_frame', type=int, default=5)
+    parser.add_argument('--solvers',
+                        type=str,
+                        nargs='+',
+                        default=['factorized', 'dct'],
+                        help='The solvers compared against lsqr')
+    args = parser.parse_args()
+    main(args)
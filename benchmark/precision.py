@@ -0,0 +1,159 @@
+import argparse
+import copy
+import os
+import sys
+import time
+
+import torch
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent_dir)
+os.chdir(parent_dir)
+
+import src.import_util  # noqa: F401 E402
+from deps.ControlNet.cldm.model import (create_model,  # noqa: E402
+                                        load_state_dict)
+from deps.gmflow.gmflow.gmflow import GMFlow  # noqa: E402
+from src.precision import (PRECISION_POLICIES,  # noqa: E402
+                           apply_precision_policy)
+
+
+def load_models(args):
+    model = create_model('./deps/ControlNet/models/cldm_v15.yaml').cpu()
+    if args.ckpt is not None:
+        model.load_state_dict(load_state_dict(args.ckpt, location='cpu'))
+    flow_model = GMFlow(
+        feature_channels=128,
+        num_scales=1,
+        upsample_factor=8,
+        num_head=1,
+        attention_type='swin',
+        ffn_dim_expansion=4,
+        num_transformer_layers=6,
+    )
+    if args.flow_ckpt is not None:
+        checkpoint = torch.load(args.flow_ckpt,
+                                map_location=lambda storage, loc: storage)
+        weights = checkpoint['model'] if 'model' in checkpoint else checkpoint
+        flow_model.load_state_dict(weights, strict=False)
+    return model.eval(), flow_model.eval()
+
+
+def make_inputs(args, model, device):
+    torch.manual_seed(0)
+    h, w = args.height, args.width
+    # The text encoder takes its device from cond_stage_model.device, which
+    # defaults to cuda, so encode with a copy that is moved to device
+    text_model = copy.deepcopy(model.cond_stage_model).to(device)
+    text_model.device = device
+    text = text_model.encode(['a cat', ''])
+    del text_model
+    hint = torch.rand(1, 3, h, w, device=device)
+    return {
+        'x': torch.randn(2, 4, h // 8, w // 8, device=device),
+        't': torch.full((2, ), 500, device=device, dtype=torch.long),
+        'cond': {
+            'c_concat': [torch.cat([hint] * 2)],
+            'c_crossattn': [text]
+        },
+        'img': torch.rand(1, 3, h, w, device=device) * 2 - 1,
+        'image1': torch.rand(1, 3, h, w, device=device) * 255,
+        'image2': torch.rand(1, 3, h, w, device=device) * 255
+    }
+
+
+def run(fn, n_iter, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    base_memory = torch.cuda.memory_allocated() if device.type == 'cuda' \
+        else 0
+    times = []
+    for _ in range(n_iter):
+        beg = time.time()
+        out = fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.time() - beg)
+    peak_memory = torch.cuda.max_memory_allocated() - base_memory \
+        if device.type == 'cuda' else None
+    return out, min(times), peak_memory
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    base_model, base_flow_model = load_models(args)
+    inputs = make_inputs(args, base_model, device)
+    refs = dict()
+    precisions = args.precisions
+    if precisions is None:
+        # CPU autocast only supports bf16
+        precisions = ['fp16', 'bf16'] if device.type == 'cuda' else ['bf16']
+    print(f'{args.height}x{args.width}, {device}')
+    for precision in ['fp32'] + precisions:
+        model = copy.deepcopy(base_model).to(device)
+        model.cond_stage_model.device = device
+        flow_model = copy.deepcopy(base_flow_model).to(device)
+        policy = apply_precision_policy(model, flow_model, precision)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+        weight_memory = sum(
+            p.numel() * p.element_size()
+            for m in (model.model, model.control_model,
+                      model.first_stage_model, flow_model)
+            for p in m.parameters())
+        print(f'{precision} {policy}: weights {weight_memory / 2**20:.0f} MB')
+
+        parts = {
+            'unet+controlnet':
+            lambda: model.apply_model(inputs['x'], inputs['t'], inputs[
+                'cond']),
+            'vae':
+            lambda: model.decode_first_stage(
+                model.get_first_stage_encoding(
+                    model.encode_first_stage(inputs['img']))),
+            'gmflow':
+            lambda: flow_model(inputs['image1'],
+                               inputs['image2'],
+                               attn_splits_list=[2],
+                               corr_radius_list=[-1],
+                               prop_radius_list=[-1],
+                               pred_bidir_flow=True)['flow_preds'][-1]
+        }
+        for name, fn in parts.items():
+            torch.manual_seed(0)
+            out, run_time, peak_memory = run(fn, args.n_iter, device)
+            out = out.float()
+            if precision == 'fp32':
+                refs[name] = out
+            diff = (out - refs[name]).abs().max().item()
+            memory = 'n/a' if peak_memory is None else \
+                f'{peak_memory / 2**20:.0f} MB'
+            print(f'  {name}: {run_time * 1000:.1f} ms, '
+                  f'peak memory {memory}, max diff to fp32 {diff:.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device',
+                        type=str,
+                        default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--ckpt',
+                        type=str,
+                        default=None,
+                        help='ControlNet weights, random weights if not set')
+    parser.add_argument('--flow_ckpt',
+                        type=str,
+                        default=None,
+                        help='GMFlow weights, random weights if not set')
+    parser.add_argument('--n_iter', type=int, default=3)
+    parser.add_argument('--precisions',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        choices=list(PRECISION_POLICIES))
+    args = parser.parse_args()
+    main(args)
@@ -1,57 +1,155 @@
+import os
+
 import cv2
 import numpy as np
 import scipy
+import scipy.fft
+
+try:
+    from sksparse.cholmod import cholesky
+except ImportError:
+    cholesky = None
+
+GRAD_WEIGHT = (2.5, 0.5, 0.5)
 
 As = None
 prev_states = None
+# Factorizations of A^T A, keyed by the gradient weight of the channel
+factors = dict()
+
+# Poisson operators only depend on (h, w, grad_weight), so they are cached
+# on disk and shared by all processes. Set to None to disable the cache.
+A_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rerender',
+                           'poisson')
 
 
 def construct_A(h, w, grad_weight):
-    indgx_x = []
-    indgx_y = []
-    indgy_x = []
-    indgy_y = []
-    vdx = []
-    vdy = []
-    for i in range(h):
-        for j in range(w):
-            if i < h - 1:
-                indgx_x += [i * w + j]
-                indgx_y += [i * w + j]
-                vdx += [1]
-                indgx_x += [i * w + j]
-                indgx_y += [(i + 1) * w + j]
-                vdx += [-1]
-            if j < w - 1:
-                indgy_x += [i * w + j]
-                indgy_y += [i * w + j]
-                vdy += [1]
-                indgy_x += [i * w + j]
-                indgy_y += [i * w + j + 1]
-                vdy += [-1]
-    Ix = scipy.sparse.coo_array(
-        (np.ones(h * w), (np.arange(h * w), np.arange(h * w))),
-        shape=(h * w, h * w)).tocsc()
-    Gx = scipy.sparse.coo_array(
-        (np.array(vdx), (np.array(indgx_x), np.array(indgx_y))),
-        shape=(h * w, h * w)).tocsc()
-    Gy = scipy.sparse.coo_array(
-        (np.array(vdy), (np.array(indgy_x), np.array(indgy_y))),
-        shape=(h * w, h * w)).tocsc()
+    n = h * w
+    ind = np.arange(n).reshape(h, w)
+
+    # A = [Gx * weight; Gy * weight; I] is assembled directly in CSR form.
+    # Row p of Gx (Gy) holds the forward difference between pixel p and its
+    # lower (right) neighbour and is empty on the last row (column).
+    px = ind[:-1, :].ravel()
+    py = ind[:, :-1].ravel()
+    indices = np.concatenate([
+        np.stack([px, px + w], 1).ravel(),
+        np.stack([py, py + 1], 1).ravel(),
+        ind.ravel()
+    ])
+    cnt_x = np.zeros((h, w), dtype=np.int64)
+    cnt_x[:-1, :] = 2
+    cnt_y = np.zeros((h, w), dtype=np.int64)
+    cnt_y[:, :-1] = 2
+    indptr = np.concatenate(
+        [[0],
+         np.cumsum(np.concatenate([cnt_x.ravel(),
+                                   cnt_y.ravel(),
+                                   np.ones(n, dtype=np.int64)]))])
+    sign = np.tile([1., -1.], px.size + py.size)
     As = []
     for i in range(3):
+        data = np.concatenate([sign * grad_weight[i], np.ones(n)])
         As += [
-            scipy.sparse.vstack([Gx * grad_weight[i], Gy * grad_weight[i], Ix])
+            scipy.sparse.csr_array((data, indices, indptr), shape=(3 * n, n))
         ]
     return As
 
 
+def get_A_cache_path(h, w, grad_weight, cache_dir=A_CACHE_DIR):
+    # repr keeps every digit, so that distinct weights never share a file
+    weight_str = '_'.join(repr(float(x)) for x in grad_weight)
+    return os.path.join(cache_dir, f'A_{h}x{w}_{weight_str}.npz')
+
+
+def load_A(h, w, grad_weight, cache_dir=A_CACHE_DIR):
+    if cache_dir is None:
+        return construct_A(h, w, grad_weight)
+
+    # The three operators share their sparsity pattern, so only the values
+    # are stored per channel.
+    path = get_A_cache_path(h, w, grad_weight, cache_dir)
+    if os.path.exists(path):
+        try:
+            with np.load(path) as f:
+                indices = f['indices']
+                indptr = f['indptr']
+                data = f['data']
+            return [
+                scipy.sparse.csr_array((data[i], indices, indptr),
+                                       shape=(3 * h * w, h * w))
+                for i in range(3)
+            ]
+        except Exception:
+            print('Warning: Failed to load the cached poisson operator.',
+                  'Rebuild it.')
+
+    As = construct_A(h, w, grad_weight)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so that concurrent workers never read
+    # a partially written operator.
+    tmp_path = f'{path[:-4]}_{os.getpid()}.tmp.npz'
+    np.savez(tmp_path,
+             indices=As[0].indices,
+             indptr=As[0].indptr,
+             data=np.stack([A.data for A in As]))
+    os.replace(tmp_path, path)
+    return As
+
+
+def factorize_normal_equation(A):
+    # A^T A = weight^2 * (Gx^T Gx + Gy^T Gy) + I is a screened Laplacian,
+    # which is SPD. Use CHOLMOD if scikit-sparse is installed, otherwise
+    # fall back to SuperLU from scipy.
+    ATA = (A.T @ A).tocsc()
+    if cholesky is not None:
+        return cholesky(ATA)
+    lu = scipy.sparse.linalg.splu(ATA, permc_spec='MMD_AT_PLUS_A')
+    return lu.solve
+
+
+def get_normal_solver(A, weight):
+    if weight not in factors:
+        factors[weight] = factorize_normal_equation(A)
+    return factors[weight]
+
+
+def solve_dct(im, gx, gy, grad_weight):
+    # With forward differences and Neumann boundaries, the normal equation
+    # (weight^2 * (Gx^T Gx + Gy^T Gy) + I) x = weight^2 * (Gx^T gx + Gy^T gy)
+    # + im is diagonalized by the 2-D DCT-II. All channels (the last axis)
+    # are solved in one batch.
+    h, w = im.shape[:2]
+    weight2 = np.square(np.asarray(grad_weight, dtype=float))
+
+    # Gx^T gx and Gy^T gy (gx and gy are zero on the last row and column)
+    div = gx.copy()
+    div[1:] -= gx[:-1]
+    div += gy
+    div[:, 1:] -= gy[:, :-1]
+    rhs = weight2 * div + im
+
+    lx = 2 - 2 * np.cos(np.pi * np.arange(h) / h)
+    ly = 2 - 2 * np.cos(np.pi * np.arange(w) / w)
+    denom = 1 + weight2 * (lx[:, None, None] + ly[None, :, None])
+    spec = scipy.fft.dctn(rhs, type=2, axes=(0, 1), norm='ortho')
+    return scipy.fft.idctn(spec / denom, type=2, axes=(0, 1), norm='ortho')
+
+
 # blendI, I1, I2, mask should be RGB unit8 type
 # return poissson fusion result (RGB unit8 type)
 # I1 and I2: propagated results from previous and subsequent key frames
 # mask: pixel selection mask
 # blendI: contrastive-preserving blending results of I1 and I2
-def poisson_fusion(blendI, I1, I2, mask, grad_weight=[2.5, 0.5, 0.5]):
+# solver: 'dct' solves all channels in closed form with the DCT,
+#         'factorized' factorizes the normal equation once per frame shape
+#         and reuses it for every frame, 'lsqr' solves each frame iteratively
+def poisson_fusion(blendI,
+                   I1,
+                   I2,
+                   mask,
+                   grad_weight=GRAD_WEIGHT,
+                   solver='lsqr'):
     global As
     global prev_states
 
@@ -69,11 +167,18 @@ def poisson_fusion(blendI, I1, I2, mask, grad_weight=[2.5, 0.5, 0.5]):
     gy[:, :-1, :] = (Ia[:, :-1, :] - Ia[:, 1:, :]) * (1 - m[:, :-1, :]) + (
         Ib[:, :-1, :] - Ib[:, 1:, :]) * m[:, :-1, :]
 
+    if solver == 'dct':
+        final = solve_dct(Iab, np.clip(gx, -100, 100), np.clip(gy, -100, 100),
+                          grad_weight)
+        final = np.clip(final, 0, 255)
+        return cv2.cvtColor(final.astype(np.uint8), cv2.COLOR_LAB2BGR)
+
     # construct A for solving Ax=b
-    crt_states = (h, w, grad_weight)
+    crt_states = (h, w, tuple(grad_weight))
     if As is None or crt_states != prev_states:
-        As = construct_A(*crt_states)
+        As = load_A(*crt_states)
         prev_states = crt_states
+        factors.clear()
 
     final = []
     for i in range(3):
@@ -85,8 +190,20 @@ def poisson_fusion(blendI, I1, I2, mask, grad_weight=[2.5, 0.5, 0.5]):
         im = im - im_mean
         A = As[i]
         b = np.vstack([im_dx * weight, im_dy * weight, im])
-        out = scipy.sparse.linalg.lsqr(A, b)
-        out_im = (out[0] + im_mean).reshape(h, w, 1)
+        if solver == 'factorized':
+            try:
+                solve = get_normal_solver(A, weight)
+            except (MemoryError, RuntimeError) as e:
+                print(f'Warning: Failed to factorize the poisson operator '
+                      f'({e}). Fall back to lsqr.')
+                solver = 'lsqr'
+        if solver == 'factorized':
+            out = solve(A.T @ b[:, 0])
+        elif solver == 'lsqr':
+            out = scipy.sparse.linalg.lsqr(A, b)[0]
+        else:
+            raise ValueError(f'Unknown poisson solver {solver}')
+        out_im = (out + im_mean).reshape(h, w, 1)
         final += [out_im]
 
     final = np.clip(np.concatenate(final, axis=2), 0, 255)
@@ -52,6 +52,10 @@ class VideoSequence:
     def interval(self):
         return self.__interval
 
+    @property
+    def tmp_dir(self):
+        return os.path.abspath(self.__tmp_dir)
+
     @property
     def blending_dir(self):
         return os.path.abspath(self.__blending_out_dir)
@@ -153,6 +157,32 @@ class VideoSequence:
 
         return path_dir
 
+    def get_bidir_flow_sequence(self, i):
+        # One entry per pair of adjacent frames (id, id + 1) in sequence i:
+        # (path of frame id, path of frame id + 1,
+        #  path of the forward flow or None, path of the backward flow or None)
+        # The backward flow of the pair is a flow of get_flow_sequence(i) and
+        # its forward flow is a flow of get_flow_sequence(i, False), so one
+        # bidirectional prediction serves both sequences.
+        beg_id = self.get_sequence_beg_id(i)
+        end_id = self.get_sequence_beg_id(i + 1)
+        res = []
+        for id in range(beg_id, end_id):
+            fwd_path = None
+            bwd_path = None
+            if id > beg_id:
+                fwd_path = os.path.join(self.__tmp_dir,
+                                        'flow_b_%04d.npy' % (id + 1))
+            if id < end_id - 1:
+                bwd_path = os.path.join(self.__tmp_dir,
+                                        'flow_f_%04d.npy' % id)
+            res.append((os.path.join(self.__input_dir,
+                                     self.__input_format % id),
+                        os.path.join(self.__input_dir,
+                                     self.__input_format % (id + 1)),
+                        fwd_path, bwd_path))
+        return res
+
     def get_input_img(self, i):
         return os.path.join(self.__input_dir, self.__input_format % i)
 
@@ -0,0 +1,122 @@
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+
+STORE_NAME = 'flow_store'
+CHUNK_ALIGN = 64
+STORE_DTYPES = ['float32', 'float16', 'int16']
+
+
+# The flows of a video packed in one file.
+# <dir>/flow_store.bin holds the flows chunk by chunk, each chunk aligned to
+# CHUNK_ALIGN bytes. <dir>/flow_store.json maps the file name of each flow
+# (e.g. flow_f_0001.npy) to the offset, shape, dtype and scale of its chunk.
+# float32 and float16 chunks are read as zero-copy views of the
+# memory-mapped file. int16 chunks are fixed point with a per-flow scale and
+# are dequantized to float32 on read.
+class FlowStore:
+
+    def __init__(self, flow_dir):
+        self.bin_path = os.path.join(flow_dir, STORE_NAME + '.bin')
+        self.index_path = os.path.join(flow_dir, STORE_NAME + '.json')
+        self.index = dict()
+        self.data = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as fp:
+                self.index = json.load(fp)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def write(self, flows, dtype='float16'):
+        # flows: iterable of (flow name, flow array)
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f'Unknown flow store dtype {dtype}')
+        offset = os.path.getsize(self.bin_path) if os.path.exists(
+            self.bin_path) else 0
+        with open(self.bin_path, 'ab') as fp:
+            for name, flow in flows:
+                flow = np.asarray(flow, dtype=np.float32)
+                scale = 1.0
+                if dtype == 'int16':
+                    max_abs = float(np.abs(flow).max())
+                    if max_abs > 0:
+                        scale = max_abs / np.iinfo(np.int16).max
+                    data = np.round(flow / scale).astype(np.int16)
+                else:
+                    data = flow.astype(dtype)
+                pad = -offset % CHUNK_ALIGN
+                fp.write(b'\0' * pad)
+                offset += pad
+                fp.write(data.tobytes())
+                self.index[name] = {
+                    'offset': offset,
+                    'shape': list(data.shape),
+                    'dtype': dtype,
+                    'scale': scale
+                }
+                offset += data.nbytes
+
+        # Replace the index atomically so that readers never see a partial
+        # index
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.index, fp)
+        os.replace(tmp_path, self.index_path)
+        self.data = None
+
+    def read(self, name):
+        info = self.index[name]
+        size = int(np.prod(info['shape']))
+        end = info['offset'] + size * np.dtype(info['dtype']).itemsize
+        if self.data is None or self.data.size < end:
+            # Copy-on-write map, so that torch gets a writable buffer
+            self.data = np.memmap(self.bin_path, dtype=np.uint8, mode='c')
+        flow = self.data[info['offset']:end].view(info['dtype']).reshape(
+            info['shape'])
+        if info['dtype'] == 'int16':
+            flow = flow.astype(np.float32) * np.float32(info['scale'])
+        return torch.from_numpy(flow)
+
+
+stores = dict()
+
+
+def get_store(save_path):
+    flow_dir = os.path.abspath(os.path.dirname(save_path))
+    name = os.path.basename(save_path)
+    store = stores.get(flow_dir)
+    if store is None or name not in store:
+        # Reload the index, another process may have packed more flows
+        store = FlowStore(flow_dir)
+        stores[flow_dir] = store
+    return store
+
+
+def has_packed_flow(save_path):
+    return os.path.basename(save_path) in get_store(save_path)
+
+
+def read_packed_flow(save_path):
+    # Returns None if the flow has not been packed
+    store = get_store(save_path)
+    name = os.path.basename(save_path)
+    if name not in store:
+        return None
+    return store.read(name)
+
+
+def pack_flows(flow_dir, dtype='float16', remove=True):
+    # Move all flow_*.npy files of flow_dir into the flow store of flow_dir
+    paths = sorted(glob.glob(os.path.join(flow_dir, 'flow_*.npy')))
+    if len(paths) == 0:
+        return
+    store = FlowStore(flow_dir)
+    store.write(((os.path.basename(p), np.load(p)) for p in paths), dtype)
+    stores[os.path.abspath(flow_dir)] = store
+    if remove:
+        for p in paths:
+            os.remove(p)
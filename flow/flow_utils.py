@@ -12,6 +12,9 @@ sys.path.insert(0, gmflow_dir)
 from gmflow.gmflow import GMFlow  # noqa: E702 E402 F401
 from utils.utils import InputPadder  # noqa: E702 E402
 
+from flow.flow_store import has_packed_flow, read_packed_flow  # noqa: E402
+from src.precision import cast_module  # noqa: E402
+
 
 def coords_grid(b, h, w, homogeneous=False, device=None):
     y, x = torch.meshgrid(torch.arange(h), torch.arange(w))  # [H, W]
@@ -91,6 +94,8 @@ def forward_backward_consistency_check(fwd_flow,
     # (https://arxiv.org/abs/1711.07837)
     assert fwd_flow.dim() == 4 and bwd_flow.dim() == 4
     assert fwd_flow.size(1) == 2 and bwd_flow.size(1) == 2
+    # The check is done in fp32 whatever the precision of GMFlow
+    fwd_flow, bwd_flow = fwd_flow.float(), bwd_flow.float()
     flow_mag = torch.norm(fwd_flow, dim=1) + torch.norm(bwd_flow,
                                                         dim=1)  # [B, H, W]
 
@@ -139,29 +144,132 @@ def get_warped_and_mask(flow_model,
     return warped_results, bwd_occ, bwd_flow
 
 
+@torch.no_grad()
+def get_flows_and_masks(flow_model, image1, image2):
+    # Batched get_warped_and_mask without the warp and the pixel consistency
+    # image1, image2: [B, 3, H, W]
+    padder = InputPadder(image1.shape, padding_factor=8)
+    image1, image2 = padder.pad(image1.cuda(), image2.cuda())
+    results_dict = flow_model(image1,
+                              image2,
+                              attn_splits_list=[2],
+                              corr_radius_list=[-1],
+                              prop_radius_list=[-1],
+                              pred_bidir_flow=True)
+    flow_pr = results_dict['flow_preds'][-1]  # [2B, 2, H, W]
+    # The first B flows are forward flows, the last B are backward
+    flow_pr = padder.unpad(flow_pr)
+    fwd_flow, bwd_flow = torch.chunk(flow_pr, 2, dim=0)  # [B, 2, H, W]
+    fwd_occ, bwd_occ = forward_backward_consistency_check(
+        fwd_flow, bwd_flow)  # [B, H, W] float
+    return bwd_occ, bwd_flow
+
+
+class FeatureCache():
+    # Caches the CNN backbone features of the last few frames fed to GMFlow,
+    # so a frame used in several pairs (e.g. the first frame and the previous
+    # key frame in the key frame pre-pass) is encoded once. Frames are
+    # identified by their content, each frame of a batch on its own, and a
+    # frame repeated in a batch is encoded once. The transformer features
+    # depend on both frames of a pair, so only the backbone features can be
+    # reused.
+
+    def __init__(self, flow_model, capacity=3):
+        self.flow_model = flow_model
+        self.capacity = capacity
+        self.entries = []
+        self.hits = 0
+        self.misses = 0
+        # Replace GMFlow.extract_feature of this instance
+        flow_model.extract_feature = self.extract_feature
+
+    def lookup(self, img):
+        for k, (key, features) in enumerate(self.entries):
+            if key.shape == img.shape and key.device == img.device and \
+                    torch.equal(key, img):
+                # move to the end as the most recently used one
+                self.entries.append(self.entries.pop(k))
+                return features
+        return None
+
+    def insert(self, img, features):
+        self.entries.append((img, features))
+        if len(self.entries) > self.capacity:
+            self.entries.pop(0)
+
+    def extract_feature(self, img0, img1):
+        # img0, img1: [B, 3, H, W]
+        imgs = torch.cat((img0, img1), dim=0).split(1)
+        res = [None] * len(imgs)
+        # the frame whose features each frame uses
+        src = list(range(len(imgs)))
+        missing = []
+        for i, img in enumerate(imgs):
+            res[i] = self.lookup(img)
+            if res[i] is not None:
+                self.hits += 1
+                continue
+            same = next((j for j in missing if torch.equal(imgs[j], img)),
+                        None)
+            if same is None:
+                missing.append(i)
+                self.misses += 1
+            else:
+                src[i] = same
+                self.hits += 1
+        if len(missing) > 0:
+            concat = torch.cat([imgs[i] for i in missing], dim=0)
+            # list of [nB, C, H, W], resolution from low to high
+            features = self.flow_model.backbone(concat)[::-1]
+            for k, i in enumerate(missing):
+                res[i] = [f[k:k + 1] for f in features]
+                self.insert(imgs[i], res[i])
+        res = [res[i] for i in src]
+        b = img0.shape[0]
+        feature0 = [torch.cat(f, dim=0) for f in zip(*res[:b])]
+        feature1 = [torch.cat(f, dim=0) for f in zip(*res[b:])]
+        return feature0, feature1
+
+    def clear(self):
+        self.entries = []
+
+
 class FlowCalc():
 
-    def __init__(self, model_path='./models/gmflow_sintel-0c07dcb3.pth'):
-        flow_model = GMFlow(
-            feature_channels=128,
-            num_scales=1,
-            upsample_factor=8,
-            num_head=1,
-            attention_type='swin',
-            ffn_dim_expansion=4,
-            num_transformer_layers=6,
-        ).to('cuda')
-
-        checkpoint = torch.load(model_path,
-                                map_location=lambda storage, loc: storage)
-        weights = checkpoint['model'] if 'model' in checkpoint else checkpoint
-        flow_model.load_state_dict(weights, strict=False)
-        flow_model.eval()
-        self.model = flow_model
+    def __init__(self,
+                 model_path='./models/gmflow_sintel-0c07dcb3.pth',
+                 precision='fp32'):
+        self.model_path = model_path
+        self.precision = precision
+        self._model = None
+
+    @property
+    def model(self):
+        # The model is loaded on first use so that processes which only read
+        # saved flows never hold a copy of GMFlow
+        if self._model is None:
+            flow_model = GMFlow(
+                feature_channels=128,
+                num_scales=1,
+                upsample_factor=8,
+                num_head=1,
+                attention_type='swin',
+                ffn_dim_expansion=4,
+                num_transformer_layers=6,
+            ).to('cuda')
+
+            checkpoint = torch.load(self.model_path,
+                                    map_location=lambda storage, loc: storage)
+            weights = checkpoint[
+                'model'] if 'model' in checkpoint else checkpoint
+            flow_model.load_state_dict(weights, strict=False)
+            flow_model.eval()
+            self._model = cast_module(flow_model, self.precision)
+        return self._model
 
     @torch.no_grad()
     def get_flow(self, image1, image2, save_path=None):
-        if save_path is not None and os.path.exists(save_path):
+        if save_path is not None and flow_exists(save_path):
             bwd_flow = read_flow(save_path)
             return bwd_flow
 
@@ -183,6 +291,78 @@ class FlowCalc():
 
         return bwd_flow
 
+    @torch.no_grad()
+    def get_bidir_flows(self,
+                        image1s,
+                        image2s,
+                        fwd_save_paths=None,
+                        bwd_save_paths=None,
+                        batch_size=4):
+        # Both directions of GMFlow's bidirectional prediction for frame pairs
+        # of the same size. The forward flow warps image2 to image1 and the
+        # backward flow warps image1 to image2. A pair is read from its saved
+        # flows instead of inferred if every given save path exists, in which
+        # case the direction without a save path is None.
+        n = len(image1s)
+        if fwd_save_paths is None:
+            fwd_save_paths = [None] * n
+        if bwd_save_paths is None:
+            bwd_save_paths = [None] * n
+        fwd_flows = [None] * n
+        bwd_flows = [None] * n
+        todo = []
+        for k in range(n):
+            paths = [
+                p for p in (fwd_save_paths[k], bwd_save_paths[k])
+                if p is not None
+            ]
+            if len(paths) > 0 and all(flow_exists(p) for p in paths):
+                if fwd_save_paths[k] is not None:
+                    fwd_flows[k] = read_flow(fwd_save_paths[k])
+                if bwd_save_paths[k] is not None:
+                    bwd_flows[k] = read_flow(bwd_save_paths[k])
+            else:
+                todo.append(k)
+
+        for beg in range(0, len(todo), batch_size):
+            ids = todo[beg:beg + batch_size]
+            image1 = torch.stack([
+                torch.from_numpy(image1s[k]).permute(2, 0, 1) for k in ids
+            ]).float()
+            image2 = torch.stack([
+                torch.from_numpy(image2s[k]).permute(2, 0, 1) for k in ids
+            ]).float()
+            padder = InputPadder(image1.shape, padding_factor=8)
+            image1, image2 = padder.pad(image1.cuda(), image2.cuda())
+            results_dict = self.model(image1,
+                                      image2,
+                                      attn_splits_list=[2],
+                                      corr_radius_list=[-1],
+                                      prop_radius_list=[-1],
+                                      pred_bidir_flow=True)
+            flow_pr = results_dict['flow_preds'][-1]  # [2B, 2, H, W]
+            # The first B flows are forward flows, the last B are backward
+            flow_pr = padder.unpad(flow_pr)
+            for idx, k in enumerate(ids):
+                fwd_flow = flow_pr[idx].unsqueeze(0)  # [1, 2, H, W]
+                bwd_flow = flow_pr[len(ids) + idx].unsqueeze(0)
+                for flow, path in ((fwd_flow, fwd_save_paths[k]),
+                                   (bwd_flow, bwd_save_paths[k])):
+                    if path is not None:
+                        np.save(path, flow.cpu().numpy())
+                fwd_flows[k] = fwd_flow
+                bwd_flows[k] = bwd_flow
+
+        return fwd_flows, bwd_flows
+
+    def get_flows(self, image1s, image2s, save_paths=None, batch_size=4):
+        # Batched get_flow for frame pairs of the same size
+        _, bwd_flows = self.get_bidir_flows(image1s,
+                                            image2s,
+                                            bwd_save_paths=save_paths,
+                                            batch_size=batch_size)
+        return bwd_flows
+
     def warp(self, img, flow, mode='bilinear'):
         expand = False
         if len(img.shape) == 2:
@@ -200,9 +380,20 @@ class FlowCalc():
         return res
 
 
+def flow_exists(save_path):
+    return os.path.exists(save_path) or has_packed_flow(save_path)
+
+
 def read_flow(save_path):
-    flow_np = np.load(save_path)
-    bwd_flow = torch.from_numpy(flow_np)
+    # Flows are returned as zero-copy views of the memory-mapped .npy file or
+    # of the flow store of its directory (see flow/flow_store.py)
+    if os.path.exists(save_path):
+        flow_np = np.load(save_path, mmap_mode='c')
+        bwd_flow = torch.from_numpy(flow_np)
+    else:
+        bwd_flow = read_packed_flow(save_path)
+        if bwd_flow is None:
+            raise FileNotFoundError(f'Cannot find flow {save_path}')
     return bwd_flow
 
 
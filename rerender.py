@@ -20,15 +20,20 @@ from deps.ControlNet.annotator.hed import HEDdetector
 from deps.ControlNet.annotator.util import HWC3
 from deps.ControlNet.cldm.cldm import ControlLDM
 from deps.ControlNet.cldm.model import create_model, load_state_dict
+from deps.ControlNet.ldm.modules.distributions.distributions import \
+    DiagonalGaussianDistribution
 from deps.gmflow.gmflow.gmflow import GMFlow
-from flow.flow_utils import get_warped_and_mask
+from flow.flow_utils import FeatureCache, flow_warp
 from src.config import RerenderConfig
+from src.control_cache import ControlMapCache
 from src.controller import AttentionControl
 from src.ddim_v_hacked import DDIMVSampler
-from src.img_util import find_flat_region, numpy2tensor
+from src.img_util import numpy2tensor
+from src.keyframe_prepass import prepare_key_frames
+from src.precision import apply_precision_policy, get_precision_policy
+from src.tiled_vae import TiledVAE
 from src.video_util import frame_to_video, get_fps, prepare_frames
 
-blur = T.GaussianBlur(kernel_size=(9, 9), sigma=(18, 18))
 totensor = T.PILToTensor()
 
 
@@ -71,6 +76,11 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
 
         detector = apply_canny
 
+    if cfg.control_cache_size > 0:
+        detector = ControlMapCache(detector, cfg.control_type, cfg.canny_low,
+                                   cfg.canny_high, cfg.control_cache_dir,
+                                   cfg.control_cache_size * 2**20)
+
     model: ControlLDM = create_model(
         './deps/ControlNet/models/cldm_v15.yaml').cpu()
     if cfg.control_type == 'HED':
@@ -98,8 +108,16 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
     except Exception:
         print('Warning: We suggest you download the fine-tuned VAE',
               'otherwise the generation quality will be degraded')
+    TiledVAE(model.first_stage_model, cfg.vae_tile_size,
+             cfg.vae_tile_overlap, cfg.vae_cache_size)
 
-    ddim_v_sampler = DDIMVSampler(model)
+    sample_tile_size = None if cfg.sample_tile_size is None else \
+        cfg.sample_tile_size // 8
+    ddim_v_sampler = DDIMVSampler(model,
+                                  attn_backend=cfg.attn_backend,
+                                  solver=cfg.solver,
+                                  tile_size=sample_tile_size,
+                                  tile_overlap=cfg.sample_tile_overlap // 8)
 
     flow_model = GMFlow(
         feature_channels=128,
@@ -116,9 +134,13 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
     weights = checkpoint['model'] if 'model' in checkpoint else checkpoint
     flow_model.load_state_dict(weights, strict=False)
     flow_model.eval()
+    apply_precision_policy(model, flow_model, cfg.precision)
+    # A pre-pass batch holds at most the first frame, the last key frame of
+    # the previous batch and its own key frames
+    feature_cache = FeatureCache(flow_model, cfg.prepass_batch_size + 2)
 
     num_samples = 1
-    ddim_steps = 20
+    ddim_steps = cfg.ddim_steps
     scale = 7.5
 
     seed = cfg.seed
@@ -138,9 +160,19 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
     x0_strength = 1 - cfg.x0_strength
     mask_period = cfg.mask_period
     firstx0 = True
-    controller = AttentionControl(cfg.inner_strength, cfg.mask_period,
-                                  cfg.cross_period, cfg.ada_period,
-                                  cfg.warp_period)
+    # The second sampling of pixel fusion computes the same as the first one
+    # until the masks are used, so it resumes from the first one there
+    resume_step = next((step for step in range(ddim_steps)
+                        if ddim_steps * mask_period[0] < step <
+                        ddim_steps * mask_period[1]), ddim_steps)
+    checkpoint_steps = [resume_step] if pixelfusion else None
+    controller = AttentionControl(cfg.inner_strength,
+                                  cfg.mask_period,
+                                  cfg.cross_period,
+                                  cfg.ada_period,
+                                  cfg.warp_period,
+                                  store_dtype=cfg.store_dtype,
+                                  offload=cfg.store_offload)
 
     imgs = sorted(os.listdir(cfg.input_dir))
     imgs = [os.path.join(cfg.input_dir, img) for img in imgs]
@@ -209,28 +241,43 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
     Image.fromarray(x_samples[0]).save(os.path.join(cfg.first_dir,
                                                     'first.jpg'))
     cv2.imwrite(os.path.join(cfg.first_dir, 'first_edge.jpg'), detected_img)
+    for key, usage in controller.memory_report().items():
+        usage = ', '.join(f'{device} {size / 2**20:.0f} MB'
+                          for device, size in usage.items())
+        print(f'Attention store {key}: {usage}')
 
     if first_img_only:
         exit(0)
 
+    def preprocess(img):
+        if color_preserve:
+            return numpy2tensor(img)
+        img_ = apply_color_correction(color_corrections, Image.fromarray(img))
+        return totensor(img_).unsqueeze(0)[:, :3] / 127.5 - 1
+
+    key_imgs = []
     for i in range(0, cfg.frame_count - 1, cfg.interval):
-        cid = i + 1
         frame = cv2.imread(imgs[i + 1])
-        print(cid)
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img = HWC3(frame)
+        key_imgs.append(HWC3(frame))
+    key_frames = prepare_key_frames(model, detector, flow_model, first_img,
+                                    key_imgs, preprocess, firstx0,
+                                    pixelfusion, cfg.smooth_boundary,
+                                    cfg.prepass_batch_size)
+    feature_cache.clear()
+    if isinstance(detector, ControlMapCache):
+        detector.report()
 
-        if color_preserve:
-            img_ = numpy2tensor(img)
-        else:
-            img_ = apply_color_correction(color_corrections,
-                                          Image.fromarray(img))
-            img_ = totensor(img_).unsqueeze(0)[:, :3] / 127.5 - 1
-        encoder_posterior = model.encode_first_stage(img_.cuda())
+    for i in range(0, cfg.frame_count - 1, cfg.interval):
+        cid = i + 1
+        print(cid)
+        key_frame = key_frames[i // cfg.interval]
+
+        encoder_posterior = DiagonalGaussianDistribution(
+            key_frame['moments'].cuda())
         x0 = model.get_first_stage_encoding(encoder_posterior).detach()
 
-        detected_map = detector(img)
-        detected_map = HWC3(detected_map)
+        detected_map = key_frame['detected_map']
 
         control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
         control = torch.stack([control for _ in range(num_samples)], dim=0)
@@ -238,33 +285,8 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
         cond['c_concat'] = [control]
         un_cond['c_concat'] = [control]
 
-        image1 = torch.from_numpy(pre_img).permute(2, 0, 1).float()
-        image2 = torch.from_numpy(img).permute(2, 0, 1).float()
-        warped_pre, bwd_occ_pre, bwd_flow_pre = get_warped_and_mask(
-            flow_model, image1, image2, pre_result, False)
-        blend_mask_pre = blur(
-            F.max_pool2d(bwd_occ_pre, kernel_size=9, stride=1, padding=4))
-        blend_mask_pre = torch.clamp(blend_mask_pre + bwd_occ_pre, 0, 1)
-
-        image1 = torch.from_numpy(first_img).permute(2, 0, 1).float()
-        warped_0, bwd_occ_0, bwd_flow_0 = get_warped_and_mask(
-            flow_model, image1, image2, first_result, False)
-        blend_mask_0 = blur(
-            F.max_pool2d(bwd_occ_0, kernel_size=9, stride=1, padding=4))
-        blend_mask_0 = torch.clamp(blend_mask_0 + bwd_occ_0, 0, 1)
-
-        if firstx0:
-            mask = 1 - F.max_pool2d(blend_mask_0, kernel_size=8)
-            controller.set_warp(
-                F.interpolate(bwd_flow_0 / 8.0,
-                              scale_factor=1. / 8,
-                              mode='bilinear'), mask)
-        else:
-            mask = 1 - F.max_pool2d(blend_mask_pre, kernel_size=8)
-            controller.set_warp(
-                F.interpolate(bwd_flow_pre / 8.0,
-                              scale_factor=1. / 8,
-                              mode='bilinear'), mask)
+        controller.set_warp(key_frame['warp_flow'].cuda(),
+                            key_frame['warp_mask'].cuda())
 
         controller.set_task('keepx0, keepstyle')
         seed_everything(seed)
@@ -279,28 +301,28 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
             unconditional_conditioning=un_cond,
             controller=controller,
             x0=x0,
-            strength=x0_strength)
+            strength=x0_strength,
+            checkpoint_steps=checkpoint_steps)
         direct_result = model.decode_first_stage(samples)
 
         if not pixelfusion:
             pre_result = direct_result
-            pre_img = img
             viz = (
                 einops.rearrange(direct_result, 'b c h w -> b h w c') * 127.5 +
                 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
 
         else:
 
+            warped_pre = flow_warp(pre_result,
+                                   key_frame['bwd_flow_pre'].cuda())
+            warped_0 = flow_warp(first_result, key_frame['bwd_flow_0'].cuda())
+            blend_mask_pre = key_frame['blend_mask_pre'].cuda()
+            blend_mask_0 = key_frame['blend_mask_0'].cuda()
             blend_results = (1 - blend_mask_pre
                              ) * warped_pre + blend_mask_pre * direct_result
             blend_results = (
                 1 - blend_mask_0) * warped_0 + blend_mask_0 * blend_results
 
-            bwd_occ = 1 - torch.clamp(1 - bwd_occ_pre + 1 - bwd_occ_0, 0, 1)
-            blend_mask = blur(
-                F.max_pool2d(bwd_occ, kernel_size=9, stride=1, padding=4))
-            blend_mask = 1 - torch.clamp(blend_mask + bwd_occ, 0, 1)
-
             encoder_posterior = model.encode_first_stage(blend_results)
             xtrg = model.get_first_stage_encoding(
                 encoder_posterior).detach()  # * mask
@@ -319,13 +341,8 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
                                   stride=1,
                                   padding=1)
 
-            mask = (1 - F.max_pool2d(1 - blend_mask, kernel_size=8)
-                    )  # * (1-mask_x)
-
-            if cfg.smooth_boundary:
-                noise_rescale = find_flat_region(mask)
-            else:
-                noise_rescale = torch.ones_like(mask)
+            mask = key_frame['mask'].cuda()  # * (1-mask_x)
+            noise_rescale = key_frame['noise_rescale'].cuda()
             masks = []
             for i in range(ddim_steps):
                 if i <= ddim_steps * mask_period[
@@ -363,10 +380,11 @@ def rerender(cfg: RerenderConfig, first_img_only: bool, key_video_path: str):
                 strength=x0_strength,
                 xtrg=xtrg,
                 mask=masks,
-                noise_rescale=noise_rescale)
+                noise_rescale=noise_rescale,
+                resume_from=intermediates.get('checkpoints',
+                                              {}).get(resume_step))
             x_samples = model.decode_first_stage(samples)
             pre_result = x_samples
-            pre_img = img
 
             viz = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 +
                    127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
@@ -392,11 +410,13 @@ def postprocess(cfg: RerenderConfig, ne: bool, max_process: int, tmp: bool,
     use_tmp = '-tmp' if tmp else ''
     use_ps = '-ps' if ps else ''
     o_video_cmd = f'--output {o_video}'
+    flow_precision = get_precision_policy(cfg.precision)['flow']
 
     cmd = (
         f'python video_blend.py {video_base_dir} --beg 1 --end {end_frame} '
         f'--itv {interval} --key {key_dir} {use_e} {o_video_cmd} --fps {fps} '
-        f'--n_proc {max_process} {use_tmp} {use_ps}')
+        f'--n_proc {max_process} {use_tmp} {use_ps} '
+        f'--flow_precision {flow_precision}')
     print(cmd)
     os.system(cmd)
 
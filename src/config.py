@@ -2,6 +2,7 @@ import json
 import os
 from typing import Optional, Sequence, Tuple
 
+from src.control_cache import CONTROL_CACHE_DIR, CONTROL_CACHE_SIZE
 from src.video_util import get_frame_count
 
 
@@ -38,6 +39,19 @@ class RerenderConfig:
                                inner_strength: float = 0.9,
                                smooth_boundary: bool = True,
                                color_preserve: bool = True,
+                               attn_backend: str = 'einsum',
+                               store_dtype: Optional[str] = None,
+                               store_offload: bool = False,
+                               solver: str = 'ddim',
+                               vae_tile_size: Optional[int] = None,
+                               vae_tile_overlap: int = 64,
+                               vae_cache_size: int = 0,
+                               sample_tile_size: Optional[int] = None,
+                               sample_tile_overlap: int = 128,
+                               precision='fp32',
+                               prepass_batch_size: int = 4,
+                               control_cache_dir: str = CONTROL_CACHE_DIR,
+                               control_cache_size: int = CONTROL_CACHE_SIZE,
                                **kwargs):
         self.input_path = input_path
         self.output_path = output_path
@@ -83,6 +97,26 @@ class RerenderConfig:
         self.inner_strength = inner_strength
         self.smooth_boundary = smooth_boundary
         self.color_preserve = color_preserve
+        self.attn_backend = attn_backend
+        self.store_dtype = store_dtype
+        self.store_offload = store_offload
+        self.solver = solver
+        self.vae_tile_size = vae_tile_size
+        self.vae_tile_overlap = vae_tile_overlap
+        # The number of recent VAE inputs whose results are kept on the device
+        self.vae_cache_size = vae_cache_size
+        self.sample_tile_size = sample_tile_size
+        self.sample_tile_overlap = sample_tile_overlap
+        # The name of a policy of src/precision.py, or a dict that maps
+        # models (unet, controlnet, vae, flow) to fp32, fp16 or bf16
+        self.precision = precision
+        # The number of key frames whose inputs are processed at once before
+        # the key frame loop
+        self.prepass_batch_size = prepass_batch_size
+        # The control maps are cached in control_cache_dir up to
+        # control_cache_size MB, 0 to disable the cache
+        self.control_cache_dir = control_cache_dir
+        self.control_cache_size = control_cache_size
 
         os.makedirs(self.input_dir, exist_ok=True)
         os.makedirs(self.work_dir, exist_ok=True)
@@ -129,6 +163,19 @@ class RerenderConfig:
         append_if_not_none('inner_strength')
         append_if_not_none('smooth_boundary')
         append_if_not_none('color_perserve')
+        append_if_not_none('attn_backend')
+        append_if_not_none('store_dtype')
+        append_if_not_none('store_offload')
+        append_if_not_none('solver')
+        append_if_not_none('vae_tile_size')
+        append_if_not_none('vae_tile_overlap')
+        append_if_not_none('vae_cache_size')
+        append_if_not_none('sample_tile_size')
+        append_if_not_none('sample_tile_overlap')
+        append_if_not_none('precision')
+        append_if_not_none('prepass_batch_size')
+        append_if_not_none('control_cache_dir')
+        append_if_not_none('control_cache_size')
         self.create_from_parameters(**kwargs)
 
     @property
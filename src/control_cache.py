@@ -0,0 +1,86 @@
+import hashlib
+import os
+
+import numpy as np
+
+CONTROL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rerender',
+                                 'control_maps')
+# in MB
+CONTROL_CACHE_SIZE = 1024
+
+
+class ControlMapCache():
+    # Wraps a detector (HEDdetector or canny) and saves its control maps in
+    # cache_dir, so that a frame is detected once across runs, e.g. when a
+    # clip is rendered again with another prompt or seed, or when the WebUI
+    # reruns the first frame. A control map is saved as <hash>.npy, where the
+    # hash covers the content of the frame, the detector type and the canny
+    # thresholds. When the maps exceed max_size bytes, the least recently
+    # used ones are deleted.
+
+    def __init__(self,
+                 detector,
+                 control_type,
+                 canny_low=None,
+                 canny_high=None,
+                 cache_dir=CONTROL_CACHE_DIR,
+                 max_size=CONTROL_CACHE_SIZE * 2**20):
+        self.detector = detector
+        self.key = f'{control_type}_{canny_low}_{canny_high}'
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, img):
+        h = hashlib.sha1(self.key.encode())
+        h.update(f'{img.shape}_{img.dtype}'.encode())
+        h.update(np.ascontiguousarray(img).tobytes())
+        return os.path.join(self.cache_dir, h.hexdigest() + '.npy')
+
+    def __call__(self, img):
+        path = self.get_path(img)
+        try:
+            detected_map = np.load(path)
+            # mark as the most recently used one
+            os.utime(path)
+            self.hits += 1
+            return detected_map
+        except (OSError, ValueError):
+            # not cached, or evicted or broken meanwhile
+            pass
+        self.misses += 1
+        detected_map = self.detector(img)
+        # Replace the file atomically so that readers never see a partial map
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            np.save(fp, detected_map)
+        os.replace(tmp_path, path)
+        self.evict()
+        return detected_map
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # The last one is the map just saved
+        for _, size, name in entries[:-1]:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def report(self):
+        print(f'Control map cache: {self.hits} hits, {self.misses} misses')
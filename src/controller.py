@@ -10,6 +10,8 @@ from flow.flow_utils import flow_warp
 
 def calc_mean_std(feat, eps=1e-5):
     # eps is a small value added to the variance to avoid divide-by-zero.
+    # The statistics are computed in at least fp32 under any precision.
+    feat = feat.to(torch.promote_types(feat.dtype, torch.float32))
     size = feat.size()
     assert (len(size) == 4)
     N, C = size[:2]
@@ -19,14 +21,58 @@ def calc_mean_std(feat, eps=1e-5):
     return feat_mean, feat_std
 
 
+STORE_DTYPES = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16
+}
+
+
+def map_tensors(fn, entry):
+    if isinstance(entry, tuple):
+        return tuple(fn(t) for t in entry)
+    return fn(entry)
+
+
+def iter_tensors(entry):
+    if isinstance(entry, dict):
+        for value in entry.values():
+            yield from iter_tensors(value)
+    elif isinstance(entry, (tuple, list)):
+        for value in entry:
+            yield from iter_tensors(value)
+    elif isinstance(entry, torch.Tensor):
+        yield entry
+
+
 class AttentionControl():
 
-    def __init__(self, inner_strength, mask_period, cross_period, ada_period,
-                 warp_period):
+    # store_dtype: None to store the tensors as they are, or a key of
+    # STORE_DTYPES to store them in that dtype.
+    # offload: keep the stored tensors in pinned CPU memory. The entries of a
+    # step are copied back to the GPU on a side stream during the step before.
+    def __init__(self,
+                 inner_strength,
+                 mask_period,
+                 cross_period,
+                 ada_period,
+                 warp_period,
+                 store_dtype=None,
+                 offload=False):
+        if store_dtype is not None and store_dtype not in STORE_DTYPES:
+            raise ValueError(f'Unknown store dtype {store_dtype}')
+        self.store_dtype = STORE_DTYPES.get(store_dtype)
+        self.offload = offload
+        self.device = None
+        self.stream = None
+        self.prefetched = dict()
         self.step_store = self.get_empty_store()
         self.cur_step = 0
         self.total_step = 0
         self.cur_index = 0
+        self.cur_branch = 0
+        self.n_branch = 1
+        self.cur_tile = 0
         self.init_store = False
         self.restore = False
         self.update = False
@@ -39,61 +85,239 @@ class AttentionControl():
         self.mask_period = mask_period
         self.ada_period = ada_period
         self.warp_period = warp_period
+        self.record = None
 
     @staticmethod
     def get_empty_store():
+        # Each store maps a denoising step to what is stored at that step, so
+        # that samplers may skip steps without shifting the indices of the
+        # following ones. 'first' and 'previous' hold a dict that maps
+        # (tile, branch, index) to the context of a self-attention call of
+        # the up blocks in the step, where tile is the latent window of tiled
+        # sampling, branch is the cond/uncond branch of classifier-free
+        # guidance and index counts the calls in the branch.
+        # 'first_kv' caches the projected keys and values of 'first'.
         return {
-            'first': [],
-            'previous': [],
-            'x0_previous': [],
-            'first_ada': []
+            'first': dict(),
+            'first_kv': dict(),
+            'previous': dict(),
+            'x0_previous': dict(),
+            'first_ada': dict()
         }
 
     def forward(self, context, is_cross: bool, place_in_unet: str):
-        cross_period = (self.total_step * self.cross_period[0],
-                        self.total_step * self.cross_period[1])
         if not is_cross and place_in_unet == 'up':
-            if self.init_store:
-                self.step_store['first'].append(context.detach())
-                self.step_store['previous'].append(context.detach())
-            if self.update:
-                tmp = context.clone().detach()
-            if self.restore and self.cur_step >= cross_period[0] and \
-                    self.cur_step <= cross_period[1]:
-                context = torch.cat(
-                    (self.step_store['first'][self.cur_index],
-                     self.step_store['previous'][self.cur_index]),
-                    dim=1).clone()
-            if self.update:
-                self.step_store['previous'][self.cur_index] = tmp
-            self.cur_index += 1
+            contexts = []
+            for index, branch_context in self.forward_branches(context):
+                if index is not None:
+                    first = self.load('first',
+                                      index).to(branch_context.dtype)
+                    branch_context = torch.cat((first, branch_context),
+                                               dim=1)
+                contexts.append(branch_context)
+            context = contexts[0] if len(contexts) == 1 else torch.cat(
+                contexts)
         return context
 
+    def project(self, context, is_cross: bool, place_in_unet: str, to_k,
+                to_v):
+        # Same as forward, but returns the keys and values of the context.
+        # The stored first frame contexts never change, so their keys and
+        # values are projected once and cached.
+        if is_cross or place_in_unet != 'up':
+            return to_k(context), to_v(context)
+        ks, vs = [], []
+        for index, branch_context in self.forward_branches(context):
+            k, v = to_k(branch_context), to_v(branch_context)
+            if index is not None:
+                first_kv = self.step_store['first_kv'].setdefault(
+                    self.cur_step, dict())
+                if index in first_kv:
+                    first_k, first_v = self.load('first_kv', index)
+                else:
+                    first = self.load('first', index).to(branch_context.dtype)
+                    first_k, first_v = to_k(first), to_v(first)
+                    first_kv[index] = map_tensors(self.pack,
+                                                  (first_k, first_v))
+                k = torch.cat((first_k.to(k.dtype), k), dim=1)
+                v = torch.cat((first_v.to(v.dtype), v), dim=1)
+            ks.append(k)
+            vs.append(v)
+        if len(ks) == 1:
+            return ks[0], vs[0]
+        return torch.cat(ks), torch.cat(vs)
+
+    def forward_branches(self, context):
+        # A batch holding several branches is processed branch by branch, so
+        # that the stores do not depend on whether the branches are evaluated
+        # in one batch or one after another.
+        # Returns (index, context) per branch. If the first frame context is
+        # to be prepended, index is its index in the store, otherwise None.
+        in_cross_period = self.in_period(self.cross_period)
+        contexts = []
+        for i, branch_context in enumerate(context.chunk(self.n_branch)):
+            contexts.append(
+                self.forward_branch(branch_context,
+                                    (self.cur_tile, self.cur_branch + i,
+                                     self.cur_index),
+                                    in_cross_period))
+        self.cur_index += 1
+        return contexts
+
+    def forward_branch(self, context, index, in_cross_period):
+        if self.record is not None:
+            self.record['previous'].setdefault(self.cur_step,
+                                               dict())[index] = \
+                context.detach()
+        if self.init_store:
+            packed = self.pack(context)
+            for key in ['first', 'previous']:
+                self.step_store[key].setdefault(self.cur_step,
+                                                dict())[index] = packed
+        stored = self.cur_step in self.step_store['first']
+        if self.update:
+            tmp = self.pack(context.clone())
+        first_index = None
+        if self.restore and stored and in_cross_period:
+            first_index = index
+            context = self.load('previous', index).to(context.dtype)
+        if self.update and stored:
+            self.step_store['previous'][self.cur_step][index] = tmp
+        return first_index, context
+
     def update_x0(self, x0):
+        if self.record is not None:
+            self.record['x0_previous'][self.cur_step] = x0.detach()
         if self.init_store:
-            self.step_store['x0_previous'].append(x0.detach())
+            self.step_store['x0_previous'][self.cur_step] = self.pack(x0)
             style_mean, style_std = calc_mean_std(x0.detach())
-            self.step_store['first_ada'].append(style_mean.detach())
-            self.step_store['first_ada'].append(style_std.detach())
+            self.step_store['first_ada'][self.cur_step] = (
+                style_mean.detach(), style_std.detach())
         if self.updatex0:
-            tmp = x0.clone().detach()
-        if self.restorex0:
-            if self.cur_step >= self.total_step * self.ada_period[
-                    0] and self.cur_step <= self.total_step * self.ada_period[
-                        1]:
-                x0 = F.instance_norm(x0) * self.step_store['first_ada'][
-                    2 * self.cur_step +
-                    1] + self.step_store['first_ada'][2 * self.cur_step]
-            if self.cur_step >= self.total_step * self.warp_period[
-                    0] and self.cur_step <= self.total_step * self.warp_period[
-                        1]:
-                pre = self.step_store['x0_previous'][self.cur_step]
+            tmp = self.pack(x0.clone())
+        stored = self.cur_step in self.step_store['x0_previous']
+        if self.restorex0 and stored:
+            if self.in_period(self.ada_period):
+                style_mean, style_std = self.step_store['first_ada'][
+                    self.cur_step]
+                x0 = F.instance_norm(x0) * style_std + style_mean
+            if self.in_period(self.warp_period):
+                pre = self.load('x0_previous').to(x0.dtype)
                 x0 = flow_warp(pre, self.flow, mode='nearest') * self.mask + (
                     1 - self.mask) * x0
-        if self.updatex0:
+        if self.updatex0 and stored:
             self.step_store['x0_previous'][self.cur_step] = tmp
         return x0
 
+    # The record holds the contexts and x0 that updatestyle and updatex0
+    # would store in the recorded steps. A later sampling with the same
+    # prefix resumes after these steps and applies them with resume().
+    def start_record(self):
+        self.record = {'previous': dict(), 'x0_previous': dict()}
+
+    def get_record(self):
+        return {key: dict(value) for key, value in self.record.items()}
+
+    def stop_record(self):
+        record = self.record
+        self.record = None
+        return record
+
+    def resume(self, record):
+        if self.update:
+            for step, contexts in record['previous'].items():
+                if step in self.step_store['first']:
+                    self.step_store['previous'][step] = {
+                        index: self.pack(context)
+                        for index, context in contexts.items()
+                    }
+        if self.updatex0:
+            for step, x0 in record['x0_previous'].items():
+                if step in self.step_store['x0_previous']:
+                    self.step_store['x0_previous'][step] = self.pack(x0)
+
+    def pack(self, tensor):
+        # Converts a tensor to be stored to the storage dtype and device
+        tensor = tensor.detach()
+        self.device = tensor.device
+        if self.store_dtype is not None:
+            tensor = tensor.to(self.store_dtype)
+        if self.offload and tensor.is_cuda:
+            packed = torch.empty(tensor.shape,
+                                 dtype=tensor.dtype,
+                                 pin_memory=True)
+            packed.copy_(tensor, non_blocking=True)
+            tensor = packed
+        return tensor
+
+    def load(self, key, index=None):
+        # Returns a stored entry of the current step on the device of the
+        # computation
+        prefetched = self.prefetched.get((key, self.cur_step, index))
+        if prefetched is not None:
+            return prefetched
+        entry = self.step_store[key][self.cur_step]
+        if index is not None:
+            entry = entry[index]
+        if self.offload:
+            entry = map_tensors(
+                lambda t: t.to(self.device, non_blocking=True), entry)
+        return entry
+
+    def prefetch(self, step):
+        # Copy the entries of step to the GPU on a side stream
+        if not self.offload or self.device is None or \
+                self.device.type != 'cuda':
+            return
+        if self.stream is None:
+            self.stream = torch.cuda.Stream(self.device)
+        cur_stream = torch.cuda.current_stream(self.device)
+        # The entries may just have been written on the current stream
+        self.stream.wait_stream(cur_stream)
+
+        def to_device(tensor):
+            tensor = tensor.to(self.device, non_blocking=True)
+            tensor.record_stream(cur_stream)
+            return tensor
+
+        with torch.cuda.stream(self.stream):
+            for key in ['first', 'first_kv', 'previous', 'x0_previous']:
+                entries = self.step_store[key].get(step)
+                if entries is None:
+                    continue
+                if key == 'x0_previous':
+                    entries = {None: entries}
+                for index, entry in entries.items():
+                    self.prefetched[(key, step,
+                                     index)] = map_tensors(to_device, entry)
+
+    def memory_report(self):
+        # Returns the bytes held by each store on each device
+        report = dict()
+        seen = set()
+        for key, store in self.step_store.items():
+            for tensor in iter_tensors(store):
+                # 'first' and 'previous' share tensors after 'initfirst'
+                if tensor.data_ptr() in seen:
+                    continue
+                seen.add(tensor.data_ptr())
+                usage = report.setdefault(key, dict())
+                device = str(tensor.device)
+                usage[device] = usage.get(
+                    device, 0) + tensor.numel() * tensor.element_size()
+        return report
+
+    def progress(self):
+        # The fraction of the sampling done before the current step
+        return self.cur_step / max(self.total_step, 1)
+
+    def in_period(self, period):
+        # The periods are fractions of the sampling, so that they select the
+        # same part of it for any number of steps and any sampler. Comparing
+        # fractions rather than step * fraction avoids rounding errors that
+        # moved the period bounds for some step counts.
+        return period[0] <= self.progress() <= period[1]
+
     def set_warp(self, flow, mask):
         self.flow = flow.clone()
         self.mask = mask.clone()
@@ -104,12 +328,34 @@ class AttentionControl():
 
     def set_step(self, step):
         self.cur_step = step
+        self.cur_index = 0
+        if self.offload:
+            if self.stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(
+                    self.stream)
+            self.prefetched = {
+                key: value
+                for key, value in self.prefetched.items() if key[1] == step
+            }
+            self.prefetch(step + 1)
+
+    def set_branch(self, branch, n_branch=1):
+        # The next UNet evaluation holds the n_branch branches from branch on
+        self.cur_branch = branch
+        self.n_branch = n_branch
+        self.cur_index = 0
+
+    def set_tile(self, tile):
+        # The next UNet evaluations are of the latent window tile
+        self.cur_tile = tile
+        self.cur_index = 0
 
     def set_total_step(self, total_step):
         self.total_step = total_step
         self.cur_index = 0
 
     def clear_store(self):
+        self.prefetched = dict()
         del self.step_store
         torch.cuda.empty_cache()
         gc.collect()
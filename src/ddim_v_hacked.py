@@ -1,21 +1,174 @@
 """SAMPLING ONLY."""
 
 # CrossAttn precision handling
+import math
 import os
+import weakref
 
 import einops
 import numpy as np
 import torch
+import torch.nn.functional as F
 from tqdm import tqdm
 
 from deps.ControlNet.ldm.modules.diffusionmodules.util import (
     extract_into_tensor, make_ddim_sampling_parameters, make_ddim_timesteps,
     noise_like)
+from src.tiled_vae import VAE_SCALE, get_tile_starts, get_tile_weight
 
 _ATTN_PRECISION = os.environ.get('ATTN_PRECISION', 'fp32')
 
-
-def register_attention_control(model, controller=None):
+ATTN_BACKENDS = ['einsum', 'sliced', 'sdpa']
+# Number of queries per slice of the sliced backend
+ATTN_SLICE_SIZE = 1024
+
+SOLVERS = ['ddim', 'dpmpp_2m', 'unipc']
+# With fewer steps, the multistep solvers use the first order at the last step
+LOWER_ORDER_FINAL_STEPS = 15
+
+# Attention backends of the patched CrossAttention.
+# q: (b h) i d, k and v: (b h) j d, mask: None or boolean (b h) 1 j
+
+
+def attention_einsum(q, k, v, scale, mask=None):
+    # force cast to fp32 to avoid overflowing
+    if _ATTN_PRECISION == 'fp32':
+        with torch.autocast(enabled=False, device_type=q.device.type):
+            q, k = q.float(), k.float()
+            sim = torch.einsum('b i d, b j d -> b i j', q, k) * scale
+    else:
+        sim = torch.einsum('b i d, b j d -> b i j', q, k) * scale
+
+    del q, k
+
+    if mask is not None:
+        max_neg_value = -torch.finfo(sim.dtype).max
+        sim.masked_fill_(~mask, max_neg_value)
+
+    # attention, what we cannot get enough of
+    sim = sim.softmax(dim=-1)
+
+    return torch.einsum('b i j, b j d -> b i d', sim, v)
+
+
+def attention_sliced(q, k, v, scale, mask=None, slice_size=ATTN_SLICE_SIZE):
+    # Only one slice of the attention matrix is held at a time
+    out = None
+    for i in range(0, q.shape[1], slice_size):
+        out_slice = attention_einsum(q[:, i:i + slice_size], k, v, scale,
+                                     mask)
+        if out is None:
+            out = out_slice.new_empty(
+                (q.shape[0], q.shape[1], out_slice.shape[2]))
+        out[:, i:i + slice_size] = out_slice
+    return out
+
+
+def attention_sdpa(q, k, v, scale, mask=None):
+    dtype = v.dtype
+    if _ATTN_PRECISION == 'fp32':
+        q, k, v = q.float(), k.float(), v.float()
+    if scale != q.shape[-1]**-0.5:
+        # Scale q beforehand, as the scale argument needs torch>=2.1
+        q = q * (scale * q.shape[-1]**0.5)
+    if _ATTN_PRECISION == 'fp32':
+        # Autocast would run the attention in the autocast dtype
+        with torch.autocast(enabled=False, device_type=q.device.type):
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    else:
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    return out.to(dtype)
+
+
+def get_attention_backend(backend):
+    if backend not in ATTN_BACKENDS:
+        raise ValueError(f'Unknown attention backend {backend}')
+    if backend == 'sdpa' and not hasattr(F, 'scaled_dot_product_attention'):
+        print('Warning: scaled_dot_product_attention needs torch>=2.0, '
+              'use sliced attention instead')
+        backend = 'sliced'
+    return {
+        'einsum': attention_einsum,
+        'sliced': attention_sliced,
+        'sdpa': attention_sdpa
+    }[backend]
+
+
+# Caches what the model computes from one part of the conditioning only, e.g.
+# the keys and values of the cross-attention layers from c_crossattn or the
+# ControlNet hint embedding from c_concat. A conditioning is identified by its
+# cond_key tensors, so a new prompt or control map gets a new entry. The
+# sampler selects the entry of the next UNet evaluation with set_conditioning
+# and resets it afterwards.
+class ConditioningCache:
+
+    def __init__(self, cond_key, capacity=4):
+        self.cond_key = cond_key
+        self.capacity = capacity
+        # (weak references to the cond_key tensors, {module: cached value})
+        self.entries = []
+        self.current = None
+
+    def set_conditioning(self, *conds):
+        if not all(
+                isinstance(c, dict) and c.get(self.cond_key) is not None
+                for c in conds):
+            self.current = None
+            return
+        tensors = [t for c in conds for t in c[self.cond_key]]
+        for i, (refs, kv) in enumerate(self.entries):
+            if len(refs) == len(tensors) and all(
+                    ref() is t for ref, t in zip(refs, tensors)):
+                self.entries.append(self.entries.pop(i))
+                self.current = kv
+                return
+        self.current = dict()
+        self.entries.append(([weakref.ref(t) for t in tensors], self.current))
+        # Drop the entries of released conditionings and the least recently
+        # used ones
+        self.entries = [
+            entry for entry in self.entries
+            if all(ref() is not None for ref in entry[0])
+        ][-self.capacity:]
+
+    def reset(self):
+        self.current = None
+
+    def clear(self):
+        self.entries = []
+        self.current = None
+
+
+def register_hint_cache(control_model, hint_cache):
+    # The hint block of ControlNet only depends on the control map
+    hint_block = control_model.input_hint_block
+    forward = hint_block.forward
+
+    def cached_forward(hint, *args, **kwargs):
+        if hint_cache.current is None:
+            return forward(hint, *args, **kwargs)
+        if hint_block not in hint_cache.current:
+            hint_cache.current[hint_block] = forward(hint, *args, **kwargs)
+        return hint_cache.current[hint_block]
+
+    hint_block.forward = cached_forward
+
+
+def register_attention_control(model,
+                               controller=None,
+                               backend='einsum',
+                               cross_attn_cache=None):
+
+    # Walking the module tree is only needed if the arguments changed
+    registered = getattr(model, 'attention_control', None)
+    if registered is not None and all(
+            a is b
+            for a, b in zip(registered, (controller, backend,
+                                         cross_attn_cache))):
+        return
+    model.attention_control = (controller, backend, cross_attn_cache)
+
+    attention = get_attention_backend(backend)
 
     def ca_forward(self, place_in_unet):
 
@@ -25,36 +178,26 @@ def register_attention_control(model, controller=None):
             q = self.to_q(x)
             is_cross = context is not None
             context = context if is_cross else x
-            context = controller(context, is_cross, place_in_unet)
-
-            k = self.to_k(context)
-            v = self.to_v(context)
+            if is_cross and cross_attn_cache is not None and \
+                    cross_attn_cache.current is not None:
+                if self not in cross_attn_cache.current:
+                    cross_attn_cache.current[self] = controller.project(
+                        context, is_cross, place_in_unet, self.to_k,
+                        self.to_v)
+                k, v = cross_attn_cache.current[self]
+            else:
+                k, v = controller.project(context, is_cross, place_in_unet,
+                                          self.to_k, self.to_v)
 
             q, k, v = map(
                 lambda t: einops.rearrange(t, 'b n (h d) -> (b h) n d', h=h),
                 (q, k, v))
 
-            # force cast to fp32 to avoid overflowing
-            if _ATTN_PRECISION == 'fp32':
-                with torch.autocast(enabled=False, device_type='cuda'):
-                    q, k = q.float(), k.float()
-                    sim = torch.einsum('b i d, b j d -> b i j', q,
-                                       k) * self.scale
-            else:
-                sim = torch.einsum('b i d, b j d -> b i j', q, k) * self.scale
-
-            del q, k
-
             if mask is not None:
                 mask = einops.rearrange(mask, 'b ... -> b (...)')
-                max_neg_value = -torch.finfo(sim.dtype).max
                 mask = einops.repeat(mask, 'b j -> (b h) () j', h=h)
-                sim.masked_fill_(~mask, max_neg_value)
 
-            # attention, what we cannot get enough of
-            sim = sim.softmax(dim=-1)
-
-            out = torch.einsum('b i j, b j d -> b i d', sim, v)
+            out = attention(q, k, v, self.scale, mask)
             out = einops.rearrange(out, '(b h) n d -> b n (h d)', h=h)
             return self.to_out(out)
 
@@ -65,6 +208,9 @@ def register_attention_control(model, controller=None):
         def __call__(self, *args):
             return args[0]
 
+        def project(self, context, is_cross, place_in_unet, to_k, to_v):
+            return to_k(context), to_v(context)
+
         def __init__(self):
             self.cur_step = 0
 
@@ -88,13 +234,118 @@ def register_attention_control(model, controller=None):
             register_recr(net[1], 'mid')
 
 
+# One step from alpha_cumprod a_s to a_t of DPM-Solver++(2M) or of UniPC
+# (bh2, order 2), written as a correction of the DDIM step with eta 0:
+# x_t = sqrt(a_t) * pred_x0 + dir_xt + correction.
+# pred_x0 is the prediction after controller.update_x0 and dir_xt keeps the
+# noise predicted by the UNet, so that the controller and the mask blending
+# work as with DDIM. state holds what the solver keeps of the previous step,
+# None at the first step or after the latent was replaced.
+# The UniPC corrector of the previous step needs the prediction of this step.
+# Its correction of x_s is propagated to x_t here.
+# Returns the correction and the state of the next step.
+def multistep_update(solver, state, pred_x0, a_s, a_t, lower_order=False):
+    lambda_s = 0.5 * math.log(a_s / (1 - a_s))
+    lambda_t = 0.5 * math.log(a_t / (1 - a_t))
+    h = lambda_t - lambda_s
+    # B(h) of the bh2 variant
+    b_h = math.expm1(-h)
+    correction = 0
+
+    if solver == 'unipc' and state is not None and \
+            state['corrector'] is not None:
+        coef, res, rho = state['corrector']
+        delta = -coef * (res + rho * (pred_x0 - state['x0']))
+        correction = correction + math.sqrt((1 - a_t) / (1 - a_s)) * delta
+
+    second_order = state is not None and not lower_order
+    pred_res = 0
+    if second_order:
+        r = (state['lambda'] - lambda_s) / h
+        d1 = (state['x0'] - pred_x0) / r
+        pred_res = 0.5 * d1
+        correction = correction - math.sqrt(a_t) * b_h * pred_res
+
+    corrector = None
+    if solver == 'unipc':
+        if second_order:
+            # Solve the order conditions of the corrector
+            phi_1 = math.expm1(-h) / -h - 1
+            phi_2 = phi_1 / -h - 0.5
+            b_1 = phi_1 / b_h
+            b_2 = 2 * phi_2 / b_h
+            rho_1 = (b_1 - b_2) / (1 - r)
+            rho = b_1 - rho_1
+            res = rho_1 * d1 - pred_res
+        else:
+            rho = 0.5
+            res = 0
+        corrector = (math.sqrt(a_t) * b_h, res, rho)
+    state = {'lambda': lambda_s, 'x0': pred_x0, 'corrector': corrector}
+    return correction, state
+
+
+# What a DDIM sampling computes before its loop for a given schedule, strength
+# and batch size: the timesteps, their timestep tensors and the DDIM
+# coefficients of each step. The sampler keeps its plans, so that all the
+# samplings of a video share them.
+class SamplingPlan:
+
+    def __init__(self, sampler, strength, batch_size, device):
+        self.total_steps = sampler.ddim_timesteps.shape[0]
+        self.steps = np.flip(sampler.ddim_timesteps)
+        self.ts = [
+            torch.full((batch_size, ), step, device=device, dtype=torch.long)
+            for step in self.steps
+        ]
+        # The step at which the latent is replaced by q_sample(x0)
+        self.x0_step = int(self.total_steps *
+                           strength) if strength >= 0 else -1
+
+        self.coefficients = []
+        for index in range(self.total_steps):
+            a_t, a_prev, sigma_t, sqrt_one_minus_at = [
+                torch.full((batch_size, 1, 1, 1), value[index], device=device)
+                for value in (sampler.ddim_alphas, sampler.ddim_alphas_prev,
+                              sampler.ddim_sigmas,
+                              sampler.ddim_sqrt_one_minus_alphas)
+            ]
+            self.coefficients.append(
+                (a_t.sqrt(), a_prev.sqrt(), sigma_t, sqrt_one_minus_at,
+                 (1. - a_prev - sigma_t**2).sqrt()))
+
+
 class DDIMVSampler(object):
 
-    def __init__(self, model, schedule='linear', **kwargs):
+    def __init__(self,
+                 model,
+                 schedule='linear',
+                 attn_backend='einsum',
+                 solver='ddim',
+                 tile_size=None,
+                 tile_overlap=16,
+                 **kwargs):
         super().__init__()
+        if solver not in SOLVERS:
+            raise ValueError(f'Unknown solver {solver}')
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.attn_backend = attn_backend
+        self.solver = solver
+        # Latents larger than tile_size are denoised in overlapping windows
+        # of tile_size, whose predictions are blended at each step
+        # (MultiDiffusion). In latent pixels.
+        if tile_size is not None and tile_overlap >= tile_size:
+            raise ValueError('The tile overlap must be smaller than the tile')
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.cross_attn_cache = ConditioningCache('c_crossattn')
+        self.hint_cache = ConditioningCache('c_concat')
+        if hasattr(model, 'control_model'):
+            register_hint_cache(model.control_model, self.hint_cache)
+        self.schedule_args = None
+        self.plans = dict()
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
@@ -154,6 +405,49 @@ class DDIMVSampler(object):
         self.register_buffer('ddim_sigmas_for_original_num_steps',
                              sigmas_for_original_sampling_steps)
 
+    def get_plan(self, S, eta, strength, batch_size, verbose=True):
+        if self.schedule_args != (S, eta):
+            self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=verbose)
+            self.schedule_args = (S, eta)
+            self.plans = dict()
+        key = (strength, batch_size)
+        if key not in self.plans:
+            self.plans[key] = SamplingPlan(self, strength, batch_size,
+                                           self.model.betas.device)
+        return self.plans[key]
+
+    def make_tiles(self, shape, cond, unconditional_conditioning):
+        # Returns the windows (y, x, cond, unconditional conditioning) of
+        # tiled sampling, or None if the latent fits in one tile. The
+        # conditionings of a window are made once per sampling, so that the
+        # conditioning caches recognize them at each step.
+        H, W = shape[2:]
+        if self.tile_size is None or max(H, W) <= self.tile_size:
+            return None
+        size = self.tile_size
+
+        def crop(conditioning, y, x):
+            if not isinstance(conditioning, dict) or \
+                    conditioning.get('c_concat') is None:
+                return conditioning
+            conditioning = dict(conditioning)
+            conditioning['c_concat'] = [
+                hint[:, :, y * VAE_SCALE:(y + size) * VAE_SCALE,
+                     x * VAE_SCALE:(x + size) * VAE_SCALE]
+                for hint in conditioning['c_concat']
+            ]
+            return conditioning
+
+        tiles = []
+        for y in get_tile_starts(H, size, self.tile_overlap):
+            for x in get_tile_starts(W, size, self.tile_overlap):
+                tiles.append((y, x, crop(cond, y, x),
+                              crop(unconditional_conditioning, y, x)))
+        # Keep the hint embeddings of all the windows
+        self.hint_cache.capacity = max(self.hint_cache.capacity,
+                                       2 * len(tiles))
+        return tiles
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -181,6 +475,10 @@ class DDIMVSampler(object):
                ucg_schedule=None,
                controller=None,
                strength=0.0,
+               partial_schedule=True,
+               checkpoint_steps=None,
+               resume_from=None,
+               batch_cfg=True,
                **kwargs):
         if conditioning is not None:
             if isinstance(conditioning, dict):
@@ -203,7 +501,9 @@ class DDIMVSampler(object):
                     print(f'Warning: Got {conditioning.shape[0]}'
                           f'conditionings but batch-size is {batch_size}')
 
-        self.make_schedule(ddim_num_steps=S, ddim_eta=eta, verbose=verbose)
+        if self.solver != 'ddim' and eta != 0:
+            raise ValueError(f'The {self.solver} solver requires eta 0')
+        plan = self.get_plan(S, eta, strength, batch_size, verbose)
         # sampling
         C, H, W = shape
         size = (batch_size, C, H, W)
@@ -232,6 +532,11 @@ class DDIMVSampler(object):
             ucg_schedule=ucg_schedule,
             controller=controller,
             strength=strength,
+            partial_schedule=partial_schedule,
+            checkpoint_steps=checkpoint_steps,
+            resume_from=resume_from,
+            batch_cfg=batch_cfg,
+            plan=plan,
         )
         return samples, intermediates
 
@@ -259,13 +564,21 @@ class DDIMVSampler(object):
                       dynamic_threshold=None,
                       ucg_schedule=None,
                       controller=None,
-                      strength=0.0):
+                      strength=0.0,
+                      partial_schedule=True,
+                      checkpoint_steps=None,
+                      resume_from=None,
+                      batch_cfg=True,
+                      plan=None):
 
         if strength == 1 and x0 is not None:
-            return x0, None
+            # Nothing is sampled, so there are no checkpoints either
+            return x0, {}
 
         register_attention_control(self.model.model.diffusion_model,
-                                   controller)
+                                   controller, self.attn_backend,
+                                   self.cross_attn_cache)
+        tiles = self.make_tiles(shape, cond, unconditional_conditioning)
 
         device = self.model.betas.device
         b = shape[0]
@@ -274,7 +587,11 @@ class DDIMVSampler(object):
         else:
             img = x_T
 
-        if timesteps is None:
+        if ddim_use_original_steps or timesteps is not None:
+            plan = None
+        if plan is not None:
+            timesteps = self.ddim_timesteps
+        elif timesteps is None:
             timesteps = self.ddpm_num_timesteps if ddim_use_original_steps \
                 else self.ddim_timesteps
         elif timesteps is not None and not ddim_use_original_steps:
@@ -296,16 +613,88 @@ class DDIMVSampler(object):
         if mask is None:
             mask = [None] * total_steps
 
+        # With x0, the latent is replaced by q_sample(x0) at start_step, so
+        # the UNet evaluations of the steps before are wasted and skipped.
+        # The skip is disabled if the mask blending at start_step would use
+        # dir_xt of the previous step. The mask period of the controller is
+        # checked as well, so that all the passes sharing the controller
+        # stores skip the same steps.
+        start_step = 0
+        if partial_schedule and x0 is not None and strength >= 0 and \
+                noise_dropout == 0:
+            start_step = int(total_steps * strength)
+            if start_step >= total_steps:
+                start_step = 0
+            elif controller is not None and \
+                    total_steps * controller.mask_period[0] < start_step < \
+                    total_steps * controller.mask_period[1]:
+                start_step = 0
+            elif xtrg is not None:
+                if isinstance(mask, list):
+                    weight = mask[start_step]
+                else:
+                    weight = mask
+                if weight is not None:
+                    start_step = 0
+
+        # checkpoint_steps: the steps before which the sampling state is saved
+        # to intermediates['checkpoints']. resume_from: a saved checkpoint,
+        # the sampling continues from it instead of running the steps before
+        # it again. The caller is responsible for that these steps would
+        # compute the same as in the sampling that saved the checkpoint.
+        checkpoint_steps = set(checkpoint_steps or [])
+        if len(checkpoint_steps) > 0:
+            intermediates['checkpoints'] = dict()
+            if controller is not None:
+                controller.start_record()
+        # The multistep solvers correct the DDIM steps with the predictions of
+        # the previous steps
+        use_solver = self.solver != 'ddim' and not ddim_use_original_steps
+        solver_state = None
+        resume_step = 0
         dir_xt = 0
+        if resume_from is not None:
+            assert resume_from['total_steps'] == total_steps
+            resume_step = resume_from['step']
+            if xtrg is not None and isinstance(mask, list):
+                assert all(weight is None for weight in mask[:resume_step])
+            img = resume_from['img']
+            dir_xt = resume_from['dir_xt']
+            solver_state = resume_from['solver_state']
+            self.set_rng_state(resume_from['rng_state'], device)
+            if controller is not None:
+                controller.resume(resume_from['controller'])
+
         for i, step in enumerate(iterator):
+            if i in checkpoint_steps:
+                self.save_checkpoint(intermediates, i, total_steps, img,
+                                     dir_xt, solver_state, device, controller,
+                                     i == max(checkpoint_steps))
+            if i < resume_step:
+                continue
+            if i < start_step:
+                # Draw the noise of the skipped q_sample of xtrg and of
+                # p_sample_ddim to keep the random stream and thus the result
+                # unchanged
+                if xtrg is not None:
+                    weight = mask[i] if isinstance(mask, list) else mask
+                    if weight is not None:
+                        noise_like(xtrg.shape, device, False)
+                noise_like(img.shape, device, False)
+                continue
             if controller is not None:
                 controller.set_step(i)
             index = total_steps - i - 1
-            ts = torch.full((b, ), step, device=device, dtype=torch.long)
+            if plan is not None:
+                ts = plan.ts[i]
+                x0_step = plan.x0_step
+            else:
+                ts = torch.full((b, ), step, device=device, dtype=torch.long)
+                x0_step = int(total_steps * strength) if strength >= 0 else -1
 
-            if strength >= 0 and i == int(
-                    total_steps * strength) and x0 is not None:
+            if i == x0_step and x0 is not None:
                 img = self.model.q_sample(x0, ts)
+                solver_state = None
             if mask is not None and xtrg is not None:
                 # TODO: deterministic forward pass?
                 if type(mask) == list:
@@ -321,6 +710,9 @@ class DDIMVSampler(object):
                     img_ref = self.model.q_sample(xtrg, ts)
                     img = img_ref * weight + (1. - weight) * (
                         img - dir_xt) + rescale * dir_xt
+                    # The corrector does not apply to the blended latent
+                    if solver_state is not None:
+                        solver_state = dict(solver_state, corrector=None)
 
             if ucg_schedule is not None:
                 assert len(ucg_schedule) == len(time_range)
@@ -341,8 +733,18 @@ class DDIMVSampler(object):
                 unconditional_conditioning=unconditional_conditioning,
                 dynamic_threshold=dynamic_threshold,
                 controller=controller,
-                return_dir=True)
+                return_dir=True,
+                batch_cfg=batch_cfg,
+                plan=plan,
+                tiles=tiles)
             img, pred_x0, dir_xt = outs
+            if use_solver:
+                correction, solver_state = multistep_update(
+                    self.solver, solver_state, pred_x0,
+                    float(self.ddim_alphas[index]),
+                    float(self.ddim_alphas_prev[index]),
+                    index == 0 and total_steps < LOWER_ORDER_FINAL_STEPS)
+                img = img + correction
             if callback:
                 callback(i)
             if img_callback:
@@ -352,8 +754,93 @@ class DDIMVSampler(object):
                 intermediates['x_inter'].append(img)
                 intermediates['pred_x0'].append(pred_x0)
 
+        if total_steps in checkpoint_steps:
+            self.save_checkpoint(intermediates, total_steps, total_steps, img,
+                                 dir_xt, solver_state, device, controller,
+                                 True)
+        if controller is not None:
+            controller.stop_record()
+
         return img, intermediates
 
+    def save_checkpoint(self, intermediates, i, total_steps, img, dir_xt,
+                        solver_state, device, controller, last):
+        if controller is not None:
+            record = controller.stop_record() if last else \
+                controller.get_record()
+        else:
+            record = None
+        intermediates['checkpoints'][i] = {
+            'step': i,
+            'total_steps': total_steps,
+            'img': img,
+            'dir_xt': dir_xt,
+            'solver_state': solver_state,
+            'rng_state': self.get_rng_state(device),
+            'controller': record
+        }
+
+    @staticmethod
+    def get_rng_state(device):
+        if torch.device(device).type == 'cuda':
+            return torch.get_rng_state(), torch.cuda.get_rng_state(device)
+        return torch.get_rng_state(), None
+
+    @staticmethod
+    def set_rng_state(state, device):
+        cpu_state, cuda_state = state
+        torch.set_rng_state(cpu_state)
+        if cuda_state is not None:
+            torch.cuda.set_rng_state(cuda_state, device)
+
+    def apply_model(self, x, t, c, *conds):
+        # conds: the conditioning dicts batched in c, whose cached results are
+        # used in this evaluation
+        self.cross_attn_cache.set_conditioning(*conds)
+        self.hint_cache.set_conditioning(*conds)
+        model_output = self.model.apply_model(x, t, c)
+        self.cross_attn_cache.reset()
+        self.hint_cache.reset()
+        return model_output
+
+    def get_model_output(self, x, c, t, unconditional_guidance_scale,
+                         unconditional_conditioning, controller, batch_cfg):
+        if unconditional_conditioning is None or \
+                unconditional_guidance_scale == 1.:
+            if controller is not None:
+                controller.set_branch(0)
+            model_output = self.apply_model(x, t, c, c)
+        elif batch_cfg and isinstance(c, dict):
+            # Evaluate cond and uncond in one batch
+            x_in = torch.cat([x] * 2)
+            t_in = torch.cat([t] * 2)
+            c_in = {
+                k: [
+                    torch.cat([c[k][i], unconditional_conditioning[k][i]])
+                    for i in range(len(c[k]))
+                ]
+                for k in c
+            }
+            if controller is not None:
+                controller.set_branch(0, 2)
+            model_t, model_uncond = self.apply_model(
+                x_in, t_in, c_in, c, unconditional_conditioning).chunk(2)
+            if controller is not None:
+                controller.set_branch(0)
+            model_output = model_uncond + unconditional_guidance_scale * (
+                model_t - model_uncond)
+        else:
+            if controller is not None:
+                controller.set_branch(0)
+            model_t = self.apply_model(x, t, c, c)
+            if controller is not None:
+                controller.set_branch(1)
+            model_uncond = self.apply_model(x, t, unconditional_conditioning,
+                                            unconditional_conditioning)
+            model_output = model_uncond + unconditional_guidance_scale * (
+                model_t - model_uncond)
+        return model_output
+
     @torch.no_grad()
     def p_sample_ddim(self,
                       x,
@@ -371,18 +858,37 @@ class DDIMVSampler(object):
                       unconditional_conditioning=None,
                       dynamic_threshold=None,
                       controller=None,
-                      return_dir=False):
+                      return_dir=False,
+                      batch_cfg=True,
+                      plan=None,
+                      tiles=None):
         b, *_, device = *x.shape, x.device
 
-        if unconditional_conditioning is None or \
-                unconditional_guidance_scale == 1.:
-            model_output = self.model.apply_model(x, t, c)
+        if tiles is None:
+            model_output = self.get_model_output(
+                x, c, t, unconditional_guidance_scale,
+                unconditional_conditioning, controller, batch_cfg)
         else:
-            model_t = self.model.apply_model(x, t, c)
-            model_uncond = self.model.apply_model(x, t,
-                                                  unconditional_conditioning)
-            model_output = model_uncond + unconditional_guidance_scale * (
-                model_t - model_uncond)
+            model_output = 0
+            weight_sum = 0
+            size = self.tile_size
+            for k, (y0, x0, c_tile, uc_tile) in enumerate(tiles):
+                # The attention stores hold the contexts of each window
+                if controller is not None:
+                    controller.set_tile(k)
+                output = self.get_model_output(
+                    x[:, :, y0:y0 + size, x0:x0 + size], c_tile, t,
+                    unconditional_guidance_scale, uc_tile, controller,
+                    batch_cfg)
+                weight = get_tile_weight(*output.shape[2:], self.tile_overlap,
+                                         device).to(output.dtype)
+                pad = (x0, x.shape[3] - x0 - output.shape[3], y0,
+                       x.shape[2] - y0 - output.shape[2])
+                model_output = model_output + F.pad(output * weight, pad)
+                weight_sum = weight_sum + F.pad(weight, pad)
+            if controller is not None:
+                controller.set_tile(0)
+            model_output = model_output / weight_sum
 
         if self.model.parameterization == 'v':
             e_t = self.model.predict_eps_from_z_and_v(x, t, model_output)
@@ -394,28 +900,39 @@ class DDIMVSampler(object):
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c,
                                                **corrector_kwargs)
 
-        if use_original_steps:
-            alphas = self.model.alphas_cumprod
-            alphas_prev = self.model.alphas_cumprod_prev
-            sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod
-            sigmas = self.model.ddim_sigmas_for_original_num_steps
+        if plan is not None and not use_original_steps:
+            sqrt_a_t, sqrt_a_prev, sigma_t, sqrt_one_minus_at, dir_xt_coef = \
+                plan.coefficients[index]
         else:
-            alphas = self.ddim_alphas
-            alphas_prev = self.ddim_alphas_prev
-            sqrt_one_minus_alphas = self.ddim_sqrt_one_minus_alphas
-            sigmas = self.ddim_sigmas
-
-        # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1),
-                                       sqrt_one_minus_alphas[index],
-                                       device=device)
+            if use_original_steps:
+                alphas = self.model.alphas_cumprod
+                alphas_prev = self.model.alphas_cumprod_prev
+                sqrt_one_minus_alphas = \
+                    self.model.sqrt_one_minus_alphas_cumprod
+                sigmas = self.model.ddim_sigmas_for_original_num_steps
+            else:
+                alphas = self.ddim_alphas
+                alphas_prev = self.ddim_alphas_prev
+                sqrt_one_minus_alphas = self.ddim_sqrt_one_minus_alphas
+                sigmas = self.ddim_sigmas
+
+            # select parameters corresponding to the currently considered
+            # timestep
+            a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
+            a_prev = torch.full((b, 1, 1, 1),
+                                alphas_prev[index],
+                                device=device)
+            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
+            sqrt_one_minus_at = torch.full((b, 1, 1, 1),
+                                           sqrt_one_minus_alphas[index],
+                                           device=device)
+            sqrt_a_t = a_t.sqrt()
+            sqrt_a_prev = a_prev.sqrt()
+            dir_xt_coef = (1. - a_prev - sigma_t**2).sqrt()
 
         # current prediction for x_0
         if self.model.parameterization != 'v':
-            pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+            pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_a_t
         else:
             pred_x0 = self.model.predict_start_from_z_and_v(x, t, model_output)
 
@@ -433,12 +950,12 @@ class DDIMVSampler(object):
             pred_x0 = controller.update_x0(pred_x0)
 
         # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
+        dir_xt = dir_xt_coef * e_t
         noise = sigma_t * noise_like(x.shape, device,
                                      repeat_noise) * temperature
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        x_prev = sqrt_a_prev * pred_x0 + dir_xt + noise
 
         if return_dir:
             return x_prev, pred_x0, dir_xt
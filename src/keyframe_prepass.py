@@ -0,0 +1,110 @@
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as T
+
+from deps.ControlNet.annotator.util import HWC3
+from flow.flow_utils import get_flows_and_masks
+from src.img_util import find_flat_region
+
+blur = T.GaussianBlur(kernel_size=(9, 9), sigma=(18, 18))
+
+
+def get_blend_mask(bwd_occ):
+    # bwd_occ: [B, H, W], pooled and blurred per frame
+    blend_mask = blur(
+        F.max_pool2d(bwd_occ, kernel_size=9, stride=1, padding=4))
+    return torch.clamp(blend_mask + bwd_occ, 0, 1)
+
+
+def to_tensor(img):
+    return torch.from_numpy(img).permute(2, 0, 1).float()
+
+
+@torch.no_grad()
+def prepare_key_frames(model,
+                       detector,
+                       flow_model,
+                       first_img,
+                       imgs,
+                       preprocess,
+                       firstx0=True,
+                       pixelfusion=True,
+                       smooth_boundary=True,
+                       batch_size=4):
+    # Compute what the key frame loop needs from the input frames alone, for
+    # batch_size key frames at a time, so that the sequential loop only runs
+    # the steps that depend on the previous results.
+    # first_img: the first frame, imgs: the key frames after it (HWC3)
+    # preprocess: maps a key frame to the VAE input [1, 3, H, W]
+    # Returns one dict per key frame, the tensors are kept on the CPU.
+    keys = []
+    for beg in range(0, len(imgs), batch_size):
+        ids = list(range(beg, min(beg + batch_size, len(imgs))))
+        n = len(ids)
+
+        # Only the posterior moments are computed here. The loop samples the
+        # posterior so that it draws the same noise as before.
+        img_ = torch.cat([preprocess(imgs[k]) for k in ids])
+        moments = model.encode_first_stage(img_.cuda()).parameters.cpu()
+
+        # The flows of each key frame to the first frame and to the previous
+        # key frame. The previous frame of the first key frame is the first
+        # frame, so that pair is computed once.
+        image1s = [first_img] * n
+        image2s = [imgs[k] for k in ids]
+        pre_ids = []
+        for k in ids:
+            if k == 0:
+                pre_ids.append(0)
+            else:
+                pre_ids.append(len(image1s))
+                image1s.append(imgs[k - 1])
+                image2s.append(imgs[k])
+        if firstx0 and not pixelfusion:
+            # Only the flows to the first frame are used
+            image1s, image2s = image1s[:n], image2s[:n]
+        image1 = torch.stack([to_tensor(img) for img in image1s])
+        image2 = torch.stack([to_tensor(img) for img in image2s])
+        bwd_occ, bwd_flow = get_flows_and_masks(flow_model, image1, image2)
+        blend_mask = get_blend_mask(bwd_occ)
+        bwd_occ_0, bwd_flow_0, blend_mask_0 = bwd_occ[:n], bwd_flow[:n], \
+            blend_mask[:n]
+
+        if firstx0:
+            warp_flow, warp_mask = bwd_flow_0, blend_mask_0
+        else:
+            warp_flow, warp_mask = bwd_flow[pre_ids], blend_mask[pre_ids]
+        warp_flow = F.interpolate(warp_flow / 8.0,
+                                  scale_factor=1. / 8,
+                                  mode='bilinear')
+        warp_mask = 1 - F.max_pool2d(warp_mask, kernel_size=8)
+
+        if pixelfusion:
+            bwd_occ_pre, bwd_flow_pre, blend_mask_pre = bwd_occ[pre_ids], \
+                bwd_flow[pre_ids], blend_mask[pre_ids]
+            bwd_occ = 1 - torch.clamp(1 - bwd_occ_pre + 1 - bwd_occ_0, 0, 1)
+            fusion_mask = blur(
+                F.max_pool2d(bwd_occ, kernel_size=9, stride=1, padding=4))
+            fusion_mask = 1 - torch.clamp(fusion_mask + bwd_occ, 0, 1)
+            mask = 1 - F.max_pool2d(1 - fusion_mask, kernel_size=8)
+
+        for j, k in enumerate(ids):
+            key = {
+                'moments': moments[j:j + 1],
+                'detected_map': HWC3(detector(imgs[k])),
+                'warp_flow': warp_flow[j:j + 1].cpu(),
+                'warp_mask': warp_mask[j:j + 1].cpu()
+            }
+            if pixelfusion:
+                key['bwd_flow_pre'] = bwd_flow_pre[j:j + 1].cpu()
+                key['blend_mask_pre'] = blend_mask_pre[j:j + 1].cpu()
+                key['bwd_flow_0'] = bwd_flow_0[j:j + 1].cpu()
+                key['blend_mask_0'] = blend_mask_0[j:j + 1].cpu()
+                key['mask'] = mask[j:j + 1].cpu()
+                if smooth_boundary:
+                    key['noise_rescale'] = find_flat_region(
+                        mask[j:j + 1]).cpu()
+                else:
+                    key['noise_rescale'] = torch.ones_like(key['mask'])
+            keys.append(key)
+    return keys
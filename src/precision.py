@@ -0,0 +1,93 @@
+import torch
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16
+}
+
+# The precision of each model of the pipeline under a policy. The parts that
+# are sensitive to rounding run in fp32 under any policy: the attention
+# softmax (with ATTN_PRECISION=fp32), the AdaIN statistics, the DDIM update
+# and the flow consistency check.
+# The SD VAE decoder overflows in fp16, so the VAE keeps fp32 under the fp16
+# policy. bf16 has the range of fp32 and is also fast on recent CPUs.
+PRECISION_POLICIES = {
+    'fp32': {
+        'unet': 'fp32',
+        'controlnet': 'fp32',
+        'vae': 'fp32',
+        'flow': 'fp32'
+    },
+    'fp16': {
+        'unet': 'fp16',
+        'controlnet': 'fp16',
+        'vae': 'fp32',
+        'flow': 'fp16'
+    },
+    'bf16': {
+        'unet': 'bf16',
+        'controlnet': 'bf16',
+        'vae': 'bf16',
+        'flow': 'bf16'
+    }
+}
+
+
+def get_precision_policy(precision):
+    # precision: the name of a policy, or a dict that maps some models to
+    # their precision, the others keep fp32
+    if isinstance(precision, str):
+        if precision not in PRECISION_POLICIES:
+            raise ValueError(f'Unknown precision policy {precision}')
+        return PRECISION_POLICIES[precision]
+    policy = dict(PRECISION_POLICIES['fp32'])
+    for part, dtype in precision.items():
+        if part not in policy or dtype not in PRECISIONS:
+            raise ValueError(f'Unknown precision {dtype} of {part}')
+        policy[part] = dtype
+    return policy
+
+
+def to_float(output):
+    if isinstance(output, torch.Tensor):
+        return output.float() if output.is_floating_point() else output
+    if isinstance(output, (list, tuple)):
+        return type(output)(to_float(o) for o in output)
+    if isinstance(output, dict):
+        return {k: to_float(v) for k, v in output.items()}
+    return output
+
+
+def cast_module(module, precision):
+    # Cast the weights of module to precision and run its forward under
+    # autocast, so that it accepts fp32 inputs. The outputs are cast back to
+    # fp32 for the code outside the module.
+    dtype = PRECISIONS[precision]
+    if dtype == torch.float32:
+        return module
+    module.to(dtype)
+    device_type = next(module.parameters()).device.type
+    forward = module.forward
+
+    def autocast_forward(*args, **kwargs):
+        with torch.autocast(device_type=device_type, dtype=dtype):
+            return to_float(forward(*args, **kwargs))
+
+    module.forward = autocast_forward
+    return module
+
+
+def apply_precision_policy(model=None, flow_model=None, precision='fp32'):
+    # model: a ControlLDM, flow_model: a GMFlow
+    policy = get_precision_policy(precision)
+    if model is not None:
+        cast_module(model.model.diffusion_model, policy['unet'])
+        if hasattr(model, 'control_model'):
+            cast_module(model.control_model, policy['controlnet'])
+        # The 1x1 quant convs are left in fp32 between the casted parts
+        cast_module(model.first_stage_model.encoder, policy['vae'])
+        cast_module(model.first_stage_model.decoder, policy['vae'])
+    if flow_model is not None:
+        cast_module(flow_model, policy['flow'])
+    return policy
@@ -0,0 +1,145 @@
+import torch
+
+from deps.ControlNet.ldm.modules.distributions.distributions import \
+    DiagonalGaussianDistribution
+
+# Downsampling factor of the VAE
+VAE_SCALE = 8
+
+
+def get_tile_starts(size, tile, overlap):
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, tile - overlap))
+    return starts + [size - tile]
+
+
+def get_tile_weight(h, w, overlap, device):
+    # Weights that fall off linearly in the overlap of neighbouring tiles. At
+    # the borders of the image the tiles are normalized by the weight sum, so
+    # the fall off does not matter there.
+    def ramp(n):
+        i = torch.arange(n, device=device, dtype=torch.float32)
+        return torch.clamp(torch.minimum(i + 1, n - i) / (overlap + 1), max=1)
+
+    return ramp(h)[:, None] * ramp(w)[None, :]
+
+
+def run_tiled(fn, x, tile, overlap, scale):
+    # Apply fn to overlapping tiles of x and blend the results.
+    # tile and overlap are in pixels of x, the results of fn are scale times
+    # larger (or smaller for scale < 1) than its inputs.
+    _, _, h, w = x.shape
+    out = None
+    weight_sum = None
+    for y0 in get_tile_starts(h, tile, overlap):
+        for x0 in get_tile_starts(w, tile, overlap):
+            res = fn(x[:, :, y0:y0 + tile, x0:x0 + tile])
+            if out is None:
+                out = torch.zeros((*res.shape[:2], int(h * scale),
+                                   int(w * scale)),
+                                  dtype=res.dtype,
+                                  device=res.device)
+                weight_sum = torch.zeros(out.shape[2:], device=res.device)
+            oy, ox = int(y0 * scale), int(x0 * scale)
+            th, tw = res.shape[2:]
+            weight = get_tile_weight(th, tw, int(overlap * scale), res.device)
+            out[:, :, oy:oy + th, ox:ox + tw] += res * weight.to(res.dtype)
+            weight_sum[oy:oy + th, ox:ox + tw] += weight
+    return out / weight_sum.to(out.dtype)
+
+
+class TiledVAE():
+    # Replaces encode and decode of the first stage model (AutoencoderKL) of
+    # an LDM.
+    # tile_size: the size in pixels of the tiles that images larger than it
+    # are encoded and decoded in, so that the activations of the VAE are
+    # bounded by the tile size. None to process the whole image at once.
+    # overlap: the overlap in pixels of neighbouring tiles, blended linearly.
+    # The VAE has no receptive field limit, so the tiles are only close to
+    # the full image result. The overlap hides the seams.
+    # capacity: the number of recent inputs whose results are cached, so that
+    # an image or a latent encoded or decoded again (e.g. the first frame when
+    # the WebUI reruns it with another prompt) is processed once. Inputs are
+    # identified by their content. The cache keeps the results on the device,
+    # so it is off by default.
+
+    def __init__(self,
+                 first_stage_model,
+                 tile_size=None,
+                 overlap=64,
+                 capacity=0):
+        if tile_size is not None and (tile_size % VAE_SCALE != 0
+                                      or overlap % VAE_SCALE != 0
+                                      or overlap >= tile_size):
+            raise ValueError('The VAE tile size and overlap must be multiples '
+                             f'of {VAE_SCALE} and overlap < tile size')
+        self.vae = first_stage_model
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.capacity = capacity
+        self.entries = {'encode': [], 'decode': []}
+        self.hits = 0
+        self.misses = 0
+        # Replace AutoencoderKL.encode and decode of this instance
+        first_stage_model.encode = self.encode
+        first_stage_model.decode = self.decode
+
+    def lookup(self, key, x):
+        if self.capacity == 0:
+            return None
+        entries = self.entries[key]
+        for k, (cached, res) in enumerate(entries):
+            if cached.shape == x.shape and cached.device == x.device and \
+                    cached.dtype == x.dtype and torch.equal(cached, x):
+                # move to the end as the most recently used one
+                entries.append(entries.pop(k))
+                self.hits += 1
+                return res
+        self.misses += 1
+        return None
+
+    def insert(self, key, x, res):
+        if self.capacity == 0:
+            return
+        entries = self.entries[key]
+        entries.append((x, res))
+        if len(entries) > self.capacity:
+            entries.pop(0)
+
+    def encode_moments(self, x):
+        return self.vae.quant_conv(self.vae.encoder(x))
+
+    def decode_latent(self, z):
+        return self.vae.decoder(self.vae.post_quant_conv(z))
+
+    @torch.no_grad()
+    def encode(self, x):
+        moments = self.lookup('encode', x)
+        if moments is None:
+            if self.tile_size is None or max(x.shape[2:]) <= self.tile_size:
+                moments = self.encode_moments(x)
+            else:
+                moments = run_tiled(self.encode_moments, x, self.tile_size,
+                                    self.overlap, 1 / VAE_SCALE)
+            self.insert('encode', x, moments)
+        # The posterior is sampled by get_first_stage_encoding, so a cached
+        # encoding still gets new noise
+        return DiagonalGaussianDistribution(moments)
+
+    @torch.no_grad()
+    def decode(self, z):
+        dec = self.lookup('decode', z)
+        if dec is None:
+            tile = None if self.tile_size is None else \
+                self.tile_size // VAE_SCALE
+            if tile is None or max(z.shape[2:]) <= tile:
+                dec = self.decode_latent(z)
+            else:
+                dec = run_tiled(self.decode_latent, z, tile,
+                                self.overlap // VAE_SCALE, VAE_SCALE)
+            self.insert('decode', z, dec)
+        return dec
+
+    def clear(self):
+        self.entries = {'encode': [], 'decode': []}
@@ -1,22 +1,24 @@
 import argparse
 import os
 import platform
-import struct
 import subprocess
 import time
 from typing import List
 
 import cv2
+import numba
 import numpy as np
 import torch.multiprocessing as mp
-from numba import njit
+from numba import njit, prange
 
 import blender.histogram_blend as histogram_blend
 from blender.guide import (BaseGuide, ColorGuide, EdgeGuide, PositionalGuide,
                            TemporalGuide)
-from blender.poisson_fusion import poisson_fusion
+from blender.poisson_fusion import GRAD_WEIGHT, load_A, poisson_fusion
 from blender.video_sequence import VideoSequence
-from flow.flow_utils import flow_calc
+from flow.flow_store import STORE_DTYPES, pack_flows
+from flow.flow_utils import flow_calc, flow_exists
+from src.precision import PRECISIONS
 from src.video_util import frame_to_video
 
 OPEN_EBSYNTH_LOG = False
@@ -35,7 +37,7 @@ else:
     exit(0)
 
 
-@njit
+@njit(cache=True)
 def g_error_mask_loop(H, W, dist1, dist2, output, weight1, weight2):
     for i in range(H):
         for j in range(W):
@@ -56,6 +58,56 @@ def g_error_mask(dist1, dist2, weight1=1, weight2=1):
     return output
 
 
+@njit(parallel=True, cache=True)
+def g_error_masks_loop(dist1s, dist2s, weight1s, weight2s, output):
+    T, H, W = dist1s.shape
+    for k in prange(T * H):
+        t = k // H
+        i = k % H
+        weight1 = weight1s[t]
+        weight2 = weight2s[t]
+        for j in range(W):
+            if weight1 == 0:
+                output[t, i, j] = 0
+            elif weight2 == 0:
+                output[t, i, j] = 1
+            elif weight1 * dist1s[t, i, j] < weight2 * dist2s[t, i, j]:
+                output[t, i, j] = 0
+            else:
+                output[t, i, j] = 1
+
+
+# Batched version of g_error_mask for a whole sequence
+# dist1s, dist2s: [T, H, W] error maps, or lists of T [H, W] maps such as the
+# memmaps of load_error. Stacked maps are handled by one kernel call, lists
+# are read one frame at a time, so that only the masks are held in memory.
+# weight1s, weight2s: [T] weights of each frame
+# backend: 'numba' (parallel) or 'numpy'
+def g_error_masks(dist1s, dist2s, weight1s, weight2s, backend='numba'):
+    weight1s = np.asarray(weight1s, dtype=np.float64)
+    weight2s = np.asarray(weight2s, dtype=np.float64)
+    if backend not in ('numba', 'numpy'):
+        raise ValueError(f'Unknown backend {backend}')
+    if isinstance(dist1s, np.ndarray) and isinstance(dist2s, np.ndarray):
+        frames = [slice(None)]
+    else:
+        frames = [slice(t, t + 1) for t in range(len(dist1s))]
+    output = np.empty((len(dist1s), *dist1s[0].shape), dtype=np.byte)
+    for f in frames:
+        dist1 = np.asarray(dist1s[f])
+        dist2 = np.asarray(dist2s[f])
+        if backend == 'numba':
+            g_error_masks_loop(dist1, dist2, weight1s[f], weight2s[f],
+                               output[f])
+        else:
+            w1 = weight1s[f, np.newaxis, np.newaxis]
+            w2 = weight2s[f, np.newaxis, np.newaxis]
+            output[f] = np.where(w1 == 0, 0,
+                                 np.where(w2 == 0, 1,
+                                          w1 * dist1 >= w2 * dist2))
+    return output
+
+
 def create_sequence(base_dir, beg, end, interval, key_dir):
     sequence = VideoSequence(base_dir, beg, end, interval, 'video', key_dir,
                              'tmp', '%04d.png', '%04d.png')
@@ -70,10 +122,6 @@ def process_one_sequence(i, video_sequence: VideoSequence):
         flow_seq = video_sequence.get_flow_sequence(i, is_forward)
         key_img_id = i if is_forward else i + 1
         key_img = video_sequence.get_key_img(key_img_id)
-        for j in range(interval - 1):
-            i1 = cv2.imread(input_seq[j])
-            i2 = cv2.imread(input_seq[j + 1])
-            flow_calc.get_flow(i1, i2, flow_seq[j])
 
         guides: List[BaseGuide] = [
             ColorGuide(input_seq),
@@ -109,16 +157,25 @@ def process_sequences(i_arr, video_sequence: VideoSequence):
         process_one_sequence(i, video_sequence)
 
 
-def run_ebsynth(video_sequence: VideoSequence):
+def run_worker(target, n_thread, i_arr, *args):
+    # Share the cores among the workers instead of each numba kernel using
+    # all of them
+    numba.set_num_threads(n_thread)
+    target(i_arr, *args)
 
-    beg = time.time()
 
+def run_parallel(target, n_task, args=()):
+    # Split the tasks 0, ..., n_task - 1 into at most MAX_PROCESS
+    # contiguous chunks and run target(chunk, *args) in one process each
     processes = []
-    mp.set_start_method('spawn')
+    ctx = mp.get_context('spawn')
+
+    n_process = min(MAX_PROCESS, n_task)
+    cnt = n_task // n_process
+    remainder = n_task % n_process
 
-    n_process = min(MAX_PROCESS, video_sequence.n_seq)
-    cnt = video_sequence.n_seq // n_process
-    remainder = video_sequence.n_seq % n_process
+    n_thread = max(1, min(numba.config.NUMBA_NUM_THREADS,
+                          (os.cpu_count() or 1) // n_process))
 
     prev_idx = 0
 
@@ -126,18 +183,53 @@ def run_ebsynth(video_sequence: VideoSequence):
         task_cnt = cnt + 1 if i < remainder else cnt
         i_arr = list(range(prev_idx, prev_idx + task_cnt))
         prev_idx += task_cnt
-        p = mp.Process(target=process_sequences, args=(i_arr, video_sequence))
+        p = ctx.Process(target=run_worker,
+                        args=(target, n_thread, i_arr, *args))
         p.start()
         processes.append(p)
     for p in processes:
         p.join()
 
+
+def precompute_flows(video_sequence: VideoSequence, batch_size=4):
+    # Compute the flows of all sequences with a single GMFlow in this
+    # process, so that ebsynth workers only read them
+    beg = time.time()
+
+    # Each bidirectional prediction gives the flows of a frame pair for both
+    # the forward and the backward sequence
+    pairs = []
+    for i in range(video_sequence.n_seq):
+        for pair in video_sequence.get_bidir_flow_sequence(i):
+            if not all(p is None or flow_exists(p) for p in pair[2:]):
+                pairs.append(pair)
+
+    for k in range(0, len(pairs), batch_size):
+        batch = pairs[k:k + batch_size]
+        image1s = [cv2.imread(p[0]) for p in batch]
+        image2s = [cv2.imread(p[1]) for p in batch]
+        fwd_save_paths = [p[2] for p in batch]
+        bwd_save_paths = [p[3] for p in batch]
+        flow_calc.get_bidir_flows(image1s, image2s, fwd_save_paths,
+                                  bwd_save_paths, batch_size)
+
+    end = time.time()
+
+    print(f'flow: {end-beg}')
+
+
+def run_ebsynth(video_sequence: VideoSequence):
+
+    beg = time.time()
+
+    run_parallel(process_sequences, video_sequence.n_seq, (video_sequence, ))
+
     end = time.time()
 
     print(f'ebsynth: {end-beg}')
 
 
-@njit
+@njit(cache=True)
 def assemble_min_error_img_loop(H, W, a, b, error_mask, out):
     for i in range(H):
         for j in range(W):
@@ -154,23 +246,61 @@ def assemble_min_error_img(a, b, error_mask):
     return out
 
 
+@njit(parallel=True, cache=True)
+def assemble_min_error_imgs_loop(a, b, error_masks, out):
+    T, H, W = error_masks.shape
+    for k in prange(T * H):
+        t = k // H
+        i = k % H
+        for j in range(W):
+            if error_masks[t, i, j] == 0:
+                out[t, i, j] = a[t, i, j]
+            else:
+                out[t, i, j] = b[t, i, j]
+
+
+# Batched version of assemble_min_error_img for a whole sequence
+# a, b: [T, H, W, 3] images
+# error_masks: [T, H, W] masks
+# backend: 'numba' (parallel) or 'numpy'
+def assemble_min_error_imgs(a, b, error_masks, backend='numba'):
+    if backend == 'numba':
+        out = np.empty_like(a)
+        assemble_min_error_imgs_loop(a, b, error_masks, out)
+    elif backend == 'numpy':
+        out = np.where(error_masks[..., np.newaxis] == 0, a, b)
+    else:
+        raise ValueError(f'Unknown backend {backend}')
+    return out
+
+
 def load_error(bin_path, img_shape):
+    # The error file of ebsynth is an int64 pixel count followed by the
+    # float32 error of each pixel. Map it instead of decoding it.
     img_size = img_shape[0] * img_shape[1]
-    with open(bin_path, 'rb') as fp:
-        bytes = fp.read()
-
-    read_size = struct.unpack('q', bytes[:8])
-    assert read_size[0] == img_size
-    float_res = struct.unpack('f' * img_size, bytes[8:])
-    res = np.array(float_res,
-                   dtype=np.float32).reshape(img_shape[0], img_shape[1])
+    header_size = np.dtype(np.int64).itemsize
+    file_size = os.path.getsize(bin_path)
+    if file_size < header_size:
+        raise ValueError(f'{bin_path} is too small to be an error map')
+    read_size = np.fromfile(bin_path, dtype=np.int64, count=1)[0]
+    if read_size != img_size:
+        raise ValueError(f'{bin_path} stores {read_size} pixels, '
+                         f'but the image has {img_size} pixels')
+    if file_size != header_size + img_size * np.dtype(np.float32).itemsize:
+        raise ValueError(f'{bin_path} has an unexpected file size')
+    res = np.memmap(bin_path,
+                    dtype=np.float32,
+                    mode='r',
+                    offset=header_size,
+                    shape=(img_shape[0], img_shape[1]))
     return res
 
 
 def process_seq(video_sequence: VideoSequence,
                 i,
                 blend_histogram=True,
-                blend_gradient=True):
+                blend_gradient=True,
+                poisson_solver='lsqr'):
 
     key1_img = cv2.imread(video_sequence.get_key_img(i))
     img_shape = key1_img.shape
@@ -190,46 +320,48 @@ def process_seq(video_sequence: VideoSequence,
     inputs = [cv2.imread(x) for x in inputs]
     flow_seq = video_sequence.get_flow_sequence(i)
 
-    dist1s = []
-    dist2s = []
-    for i in range(interval - 1):
-        bin_a = binas[i + 1]
-        bin_b = binbs[i + 1]
-        dist1s.append(load_error(bin_a, img_shape))
-        dist2s.append(load_error(bin_b, img_shape))
-
     lb = 0
     ub = 1
     beg = time.time()
-    p_mask = None
 
     # write key img
     blend_out_path = video_sequence.get_blending_img(beg_id)
     cv2.imwrite(blend_out_path, key1_img)
 
-    for i in range(interval - 1):
+    n_frame = interval - 1
+    weight1s = np.arange(n_frame) / n_frame * (ub - lb) + lb
+    weight2s = 1 - weight1s
+    dist1s = [load_error(x, img_shape) for x in binas[1:n_frame + 1]]
+    dist2s = [load_error(x, img_shape) for x in binbs[1:n_frame + 1]]
+    masks = g_error_masks(dist1s, dist2s, weight1s, weight2s)
+    del dist1s, dist2s
+
+    # the mask of each frame also covers the warped mask of its previous one
+    for i in range(1, n_frame):
+        flow_path = flow_seq[i]
+        flow = flow_calc.get_flow(inputs[i], inputs[i + 1], flow_path)
+        p_mask = flow_calc.warp(masks[i - 1], flow, 'nearest')
+        masks[i] |= p_mask
+
+    # Save tmp mask
+    # for i in range(n_frame):
+    #     out_mask = np.expand_dims(masks[i], 2)
+    #     cv2.imwrite(f'mask/mask_{beg_id + i + 1:04d}.jpg', out_mask * 255)
+
+    oas = np.stack(oas[1:])
+    obs = np.stack(obs[1:])
+    min_error_imgs = assemble_min_error_imgs(oas, obs, masks)
+
+    for i in range(n_frame):
         c_id = beg_id + i + 1
         blend_out_path = video_sequence.get_blending_img(c_id)
 
-        dist1 = dist1s[i]
-        dist2 = dist2s[i]
-        oa = oas[i + 1]
-        ob = obs[i + 1]
-        weight1 = i / (interval - 1) * (ub - lb) + lb
-        weight2 = 1 - weight1
-        mask = g_error_mask(dist1, dist2, weight1, weight2)
-        if p_mask is not None:
-            flow_path = flow_seq[i]
-            flow = flow_calc.get_flow(inputs[i], inputs[i + 1], flow_path)
-            p_mask = flow_calc.warp(p_mask, flow, 'nearest')
-            mask = p_mask | mask
-        p_mask = mask
-
-        # Save tmp mask
-        # out_mask = np.expand_dims(mask, 2)
-        # cv2.imwrite(f'mask/mask_{c_id:04d}.jpg', out_mask * 255)
-
-        min_error_img = assemble_min_error_img(oa, ob, mask)
+        oa = oas[i]
+        ob = obs[i]
+        weight1 = weight1s[i]
+        weight2 = weight2s[i]
+        mask = masks[i]
+        min_error_img = min_error_imgs[i]
         if blend_histogram:
             hb_res = histogram_blend.blend(oa, ob, min_error_img,
                                            (1 - weight1), (1 - weight2))
@@ -244,7 +376,11 @@ def process_seq(video_sequence: VideoSequence,
 
         # gradient blend
         if blend_gradient:
-            res = poisson_fusion(hb_res, oa, ob, mask)
+            res = poisson_fusion(hb_res,
+                                 oa,
+                                 ob,
+                                 mask,
+                                 solver=poisson_solver)
         else:
             res = hb_res
 
@@ -253,18 +389,55 @@ def process_seq(video_sequence: VideoSequence,
     print('others:', end - beg)
 
 
+def process_seqs(i_arr,
+                 video_sequence: VideoSequence,
+                 blend_histogram=True,
+                 blend_gradient=True,
+                 poisson_solver='lsqr'):
+    for i in i_arr:
+        process_seq(video_sequence, i, blend_histogram, blend_gradient,
+                    poisson_solver)
+
+
+def run_blending(video_sequence: VideoSequence,
+                 blend_histogram=True,
+                 blend_gradient=True,
+                 poisson_solver='lsqr'):
+
+    beg = time.time()
+
+    args = (video_sequence, blend_histogram, blend_gradient, poisson_solver)
+    if MAX_PROCESS <= 1:
+        process_seqs(range(video_sequence.n_seq), *args)
+    else:
+        if blend_gradient and poisson_solver != 'dct':
+            # Build the poisson operator once here. The workers then load it
+            # from the disk cache instead of all rebuilding it.
+            key_img = cv2.imread(video_sequence.get_key_img(0))
+            load_A(*key_img.shape[:2], GRAD_WEIGHT)
+        run_parallel(process_seqs, video_sequence.n_seq, args)
+
+    end = time.time()
+
+    print(f'blending: {end-beg}')
+
+
 def main(args):
     global MAX_PROCESS
     MAX_PROCESS = args.n_proc
+    flow_calc.precision = args.flow_precision
 
     video_sequence = create_sequence(f'{args.name}', args.beg, args.end,
                                      args.itv, args.key)
     if not args.ne:
+        precompute_flows(video_sequence, args.flow_batch)
+        if args.flow_store is not None:
+            pack_flows(video_sequence.tmp_dir, args.flow_store)
         run_ebsynth(video_sequence)
     blend_histogram = True
     blend_gradient = args.ps
-    for i in range(video_sequence.n_seq):
-        process_seq(video_sequence, i, blend_histogram, blend_gradient)
+    run_blending(video_sequence, blend_histogram, blend_gradient,
+                 args.ps_solver)
     if args.output:
         frame_to_video(args.output, video_sequence.blending_dir, args.fps,
                        False)
@@ -303,9 +476,31 @@ if __name__ == '__main__':
                         type=int,
                         default=8,
                         help='The max process count')
+    parser.add_argument('--flow_batch',
+                        type=int,
+                        default=4,
+                        help='The number of frame pairs per GMFlow batch')
+    parser.add_argument('--flow_store',
+                        type=str,
+                        default=None,
+                        choices=STORE_DTYPES,
+                        help='Pack the flows into one memory-mapped file '
+                        'with the given precision')
+    parser.add_argument('--flow_precision',
+                        type=str,
+                        default='fp32',
+                        choices=list(PRECISIONS),
+                        help='The precision of GMFlow')
     parser.add_argument('-ps',
                         action='store_true',
                         help='Use poisson gradient blending')
+    parser.add_argument('--ps_solver',
+                        type=str,
+                        default='lsqr',
+                        choices=['dct', 'factorized', 'lsqr'],
+                        help='The solver of poisson gradient blending. dct '
+                        'and factorized are faster but do not give exactly '
+                        'the lsqr result')
     parser.add_argument(
         '-ne',
         action='store_true',
@@ -20,13 +20,20 @@ from deps.ControlNet.annotator.canny import CannyDetector
 from deps.ControlNet.annotator.hed import HEDdetector
 from deps.ControlNet.annotator.util import HWC3
 from deps.ControlNet.cldm.model import create_model, load_state_dict
+from deps.ControlNet.ldm.modules.distributions.distributions import \
+    DiagonalGaussianDistribution
 from deps.gmflow.gmflow.gmflow import GMFlow
-from flow.flow_utils import get_warped_and_mask
+from flow.flow_utils import FeatureCache, flow_warp
 from sd_model_cfg import model_dict
 from src.config import RerenderConfig
+from src.control_cache import (CONTROL_CACHE_DIR, CONTROL_CACHE_SIZE,
+                               ControlMapCache)
 from src.controller import AttentionControl
-from src.ddim_v_hacked import DDIMVSampler
-from src.img_util import find_flat_region, numpy2tensor
+from src.ddim_v_hacked import SOLVERS, DDIMVSampler
+from src.img_util import numpy2tensor
+from src.keyframe_prepass import prepare_key_frames
+from src.precision import apply_precision_policy
+from src.tiled_vae import TiledVAE
 from src.video_util import (frame_to_video, get_fps, get_frame_count,
                             prepare_frames)
 
@@ -35,7 +42,11 @@ for k, v in model_dict.items():
     inversed_model_dict[v] = k
 
 to_tensor = T.PILToTensor()
-blur = T.GaussianBlur(kernel_size=(9, 9), sigma=(18, 18))
+
+# The precision policy of the models, see src/precision.py
+PRECISION = os.environ.get('RERENDER_PRECISION', 'fp32')
+# The attention backend of the UNet, see src/ddim_v_hacked.py
+ATTN_BACKEND = os.environ.get('RERENDER_ATTN_BACKEND', 'einsum')
 
 
 class ProcessingState(Enum):
@@ -50,6 +61,8 @@ class GlobalState:
         self.sd_model = None
         self.ddim_v_sampler = None
         self.detector_type = None
+        # The arguments the detector was built with
+        self.detector_key = None
         self.detector = None
         self.controller = None
         self.processing_state = ProcessingState.NULL
@@ -68,16 +81,30 @@ class GlobalState:
         weights = checkpoint['model'] if 'model' in checkpoint else checkpoint
         flow_model.load_state_dict(weights, strict=False)
         flow_model.eval()
+        apply_precision_policy(flow_model=flow_model, precision=PRECISION)
+        self.feature_cache = FeatureCache(flow_model)
         self.flow_model = flow_model
 
-    def update_controller(self, inner_strength, mask_period, cross_period,
-                          ada_period, warp_period):
-        self.controller = AttentionControl(inner_strength, mask_period,
-                                           cross_period, ada_period,
-                                           warp_period)
-
-    def update_sd_model(self, sd_model, control_type):
+    def update_controller(self,
+                          inner_strength,
+                          mask_period,
+                          cross_period,
+                          ada_period,
+                          warp_period,
+                          store_dtype=None,
+                          store_offload=False):
+        self.controller = AttentionControl(inner_strength,
+                                           mask_period,
+                                           cross_period,
+                                           ada_period,
+                                           warp_period,
+                                           store_dtype=store_dtype,
+                                           offload=store_offload)
+
+    def update_sd_model(self, sd_model, control_type, solver='ddim'):
         if sd_model == self.sd_model:
+            # The solver is only read when sampling
+            self.ddim_v_sampler.solver = solver
             return
         self.sd_model = sd_model
         model = create_model('./deps/ControlNet/models/cldm_v15.yaml').cpu()
@@ -107,16 +134,29 @@ class GlobalState:
             print('Warning: We suggest you download the fine-tuned VAE',
                   'otherwise the generation quality will be degraded')
 
-        self.ddim_v_sampler = DDIMVSampler(model)
+        apply_precision_policy(model, precision=PRECISION)
+        # The first frame is encoded again when process1 is rerun
+        TiledVAE(model.first_stage_model, capacity=2)
+        self.ddim_v_sampler = DDIMVSampler(model,
+                                           attn_backend=ATTN_BACKEND,
+                                           solver=solver)
 
     def clear_sd_model(self):
         self.sd_model = None
         self.ddim_v_sampler = None
         torch.cuda.empty_cache()
 
-    def update_detector(self, control_type, canny_low=100, canny_high=200):
-        if self.detector_type == control_type:
+    def update_detector(self,
+                        control_type,
+                        canny_low=100,
+                        canny_high=200,
+                        cache_dir=CONTROL_CACHE_DIR,
+                        cache_size=CONTROL_CACHE_SIZE):
+        key = (control_type, canny_low, canny_high, cache_dir, cache_size)
+        if self.detector_key == key:
             return
+        self.detector_key = key
+        self.detector_type = control_type
         if control_type == 'HED':
             self.detector = HEDdetector()
         elif control_type == 'canny':
@@ -128,6 +168,10 @@ class GlobalState:
                 return canny_detector(x, low_threshold, high_threshold)
 
             self.detector = apply_canny
+        if cache_size > 0:
+            self.detector = ControlMapCache(self.detector, control_type,
+                                            canny_low, canny_high, cache_dir,
+                                            cache_size * 2**20)
 
 
 global_state = GlobalState()
@@ -142,7 +186,7 @@ def create_cfg(input_path, prompt, image_resolution, control_strength,
                x0_strength, use_constraints, cross_start, cross_end,
                style_update_freq, warp_start, warp_end, mask_start, mask_end,
                ada_start, ada_end, mask_strength, inner_strength,
-               smooth_boundary):
+               smooth_boundary, solver):
     use_warp = 'shape-aware fusion' in use_constraints
     use_mask = 'pixel-aware fusion' in use_constraints
     use_ada = 'color-aware AdaIN' in use_constraints
@@ -189,7 +233,8 @@ def create_cfg(input_path, prompt, image_resolution, control_strength,
         mask_strength=mask_strength,
         inner_strength=inner_strength,
         smooth_boundary=smooth_boundary,
-        color_preserve=color_preserve)
+        color_preserve=color_preserve,
+        solver=solver)
     return cfg
 
 
@@ -212,7 +257,7 @@ def cfg_to_input(filename):
         cfg.x0_strength, use_constraints, *cfg.cross_period,
         cfg.style_update_freq, *cfg.warp_period, *cfg.mask_period,
         *cfg.ada_period, cfg.mask_strength, cfg.inner_strength,
-        cfg.smooth_boundary
+        cfg.smooth_boundary, cfg.solver
     ]
     return args
 
@@ -255,12 +300,14 @@ def process1(*args):
     global global_video_path
     cfg = create_cfg(global_video_path, *args)
     global global_state
-    global_state.update_sd_model(cfg.sd_model, cfg.control_type)
+    global_state.update_sd_model(cfg.sd_model, cfg.control_type, cfg.solver)
     global_state.update_controller(cfg.inner_strength, cfg.mask_period,
                                    cfg.cross_period, cfg.ada_period,
-                                   cfg.warp_period)
+                                   cfg.warp_period, cfg.store_dtype,
+                                   cfg.store_offload)
     global_state.update_detector(cfg.control_type, cfg.canny_low,
-                                 cfg.canny_high)
+                                 cfg.canny_high, cfg.control_cache_dir,
+                                 cfg.control_cache_size)
     global_state.processing_state = ProcessingState.FIRST_IMG
 
     prepare_frames(cfg.input_path, cfg.input_dir, cfg.image_resolution,
@@ -353,6 +400,8 @@ def process1(*args):
         global_state.first_result = x_samples
         global_state.first_img = img
 
+    if isinstance(detector, ControlMapCache):
+        detector.report()
     Image.fromarray(x_samples_np[0]).save(
         os.path.join(cfg.first_dir, 'first.jpg'))
 
@@ -369,9 +418,10 @@ def process2(*args):
                        ' all key images')
 
     cfg = create_cfg(global_video_path, *args)
-    global_state.update_sd_model(cfg.sd_model, cfg.control_type)
+    global_state.update_sd_model(cfg.sd_model, cfg.control_type, cfg.solver)
     global_state.update_detector(cfg.control_type, cfg.canny_low,
-                                 cfg.canny_high)
+                                 cfg.canny_high, cfg.control_cache_dir,
+                                 cfg.control_cache_size)
     global_state.processing_state = ProcessingState.KEY_IMGS
 
     # reset key dir
@@ -389,81 +439,77 @@ def process2(*args):
     eta = 0.0
     firstx0 = True
     pixelfusion = cfg.use_mask
+    # The second sampling of pixel fusion computes the same as the first one
+    # until the masks are used, so it resumes from the first one there
+    resume_step = next((step for step in range(cfg.ddim_steps)
+                        if cfg.ddim_steps * cfg.mask_period[0] < step <
+                        cfg.ddim_steps * cfg.mask_period[1]), cfg.ddim_steps)
+    checkpoint_steps = [resume_step] if pixelfusion else None
     imgs = sorted(os.listdir(cfg.input_dir))
     imgs = [os.path.join(cfg.input_dir, img) for img in imgs]
 
     first_result = global_state.first_result
     first_img = global_state.first_img
     pre_result = first_result
-    pre_img = first_img
 
+    def preprocess(img):
+        if cfg.color_preserve or global_state.color_corrections is None:
+            return numpy2tensor(img)
+        img_ = apply_color_correction(global_state.color_corrections,
+                                      Image.fromarray(img))
+        return to_tensor(img_).unsqueeze(0)[:, :3] / 127.5 - 1
+
+    key_imgs = []
     for i in range(0, cfg.frame_count - 1, cfg.interval):
-        cid = i + 1
         frame = cv2.imread(imgs[i + 1])
-        print(cid)
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img = HWC3(frame)
-        H, W, C = img.shape
+        key_imgs.append(HWC3(frame))
+    # A pre-pass batch holds at most the first frame, the last key frame of
+    # the previous batch and its own key frames
+    global_state.feature_cache.capacity = cfg.prepass_batch_size + 2
+    key_frames = prepare_key_frames(model, detector, flow_model, first_img,
+                                    key_imgs, preprocess, firstx0,
+                                    pixelfusion, cfg.smooth_boundary,
+                                    cfg.prepass_batch_size)
+    global_state.feature_cache.clear()
+    if isinstance(detector, ControlMapCache):
+        detector.report()
+
+    # The prompts are encoded once, so that the sampler reuses their
+    # attention keys and values across the key frames
+    cond = {
+        'c_crossattn': [
+            model.get_learned_conditioning([cfg.prompt + ', ' + cfg.a_prompt] *
+                                           num_samples)
+        ]
+    }
+    un_cond = {
+        'c_crossattn':
+        [model.get_learned_conditioning([cfg.n_prompt] * num_samples)]
+    }
 
-        if cfg.color_preserve or global_state.color_corrections is None:
-            img_ = numpy2tensor(img)
-        else:
-            img_ = apply_color_correction(global_state.color_corrections,
-                                          Image.fromarray(img))
-            img_ = to_tensor(img_).unsqueeze(0)[:, :3] / 127.5 - 1
-        encoder_posterior = model.encode_first_stage(img_.cuda())
+    for i in range(0, cfg.frame_count - 1, cfg.interval):
+        cid = i + 1
+        print(cid)
+        key_frame = key_frames[i // cfg.interval]
+        H, W, C = key_imgs[i // cfg.interval].shape
+
+        encoder_posterior = DiagonalGaussianDistribution(
+            key_frame['moments'].cuda())
         x0 = model.get_first_stage_encoding(encoder_posterior).detach()
 
-        detected_map = detector(img)
-        detected_map = HWC3(detected_map)
+        detected_map = key_frame['detected_map']
 
         control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
         control = torch.stack([control for _ in range(num_samples)], dim=0)
         control = einops.rearrange(control, 'b h w c -> b c h w').clone()
-        cond = {
-            'c_concat': [control],
-            'c_crossattn': [
-                model.get_learned_conditioning(
-                    [cfg.prompt + ', ' + cfg.a_prompt] * num_samples)
-            ]
-        }
-        un_cond = {
-            'c_concat': [control],
-            'c_crossattn':
-            [model.get_learned_conditioning([cfg.n_prompt] * num_samples)]
-        }
         shape = (4, H // 8, W // 8)
 
         cond['c_concat'] = [control]
         un_cond['c_concat'] = [control]
 
-        image1 = torch.from_numpy(pre_img).permute(2, 0, 1).float()
-        image2 = torch.from_numpy(img).permute(2, 0, 1).float()
-        warped_pre, bwd_occ_pre, bwd_flow_pre = get_warped_and_mask(
-            flow_model, image1, image2, pre_result, False)
-        blend_mask_pre = blur(
-            F.max_pool2d(bwd_occ_pre, kernel_size=9, stride=1, padding=4))
-        blend_mask_pre = torch.clamp(blend_mask_pre + bwd_occ_pre, 0, 1)
-
-        image1 = torch.from_numpy(first_img).permute(2, 0, 1).float()
-        warped_0, bwd_occ_0, bwd_flow_0 = get_warped_and_mask(
-            flow_model, image1, image2, first_result, False)
-        blend_mask_0 = blur(
-            F.max_pool2d(bwd_occ_0, kernel_size=9, stride=1, padding=4))
-        blend_mask_0 = torch.clamp(blend_mask_0 + bwd_occ_0, 0, 1)
-
-        if firstx0:
-            mask = 1 - F.max_pool2d(blend_mask_0, kernel_size=8)
-            controller.set_warp(
-                F.interpolate(bwd_flow_0 / 8.0,
-                              scale_factor=1. / 8,
-                              mode='bilinear'), mask)
-        else:
-            mask = 1 - F.max_pool2d(blend_mask_pre, kernel_size=8)
-            controller.set_warp(
-                F.interpolate(bwd_flow_pre / 8.0,
-                              scale_factor=1. / 8,
-                              mode='bilinear'), mask)
+        controller.set_warp(key_frame['warp_flow'].cuda(),
+                            key_frame['warp_mask'].cuda())
 
         controller.set_task('keepx0, keepstyle')
         seed_everything(cfg.seed)
@@ -478,28 +524,28 @@ def process2(*args):
             unconditional_conditioning=un_cond,
             controller=controller,
             x0=x0,
-            strength=1 - cfg.x0_strength)
+            strength=1 - cfg.x0_strength,
+            checkpoint_steps=checkpoint_steps)
         direct_result = model.decode_first_stage(samples)
 
         if not pixelfusion:
             pre_result = direct_result
-            pre_img = img
             viz = (
                 einops.rearrange(direct_result, 'b c h w -> b h w c') * 127.5 +
                 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
 
         else:
 
+            warped_pre = flow_warp(pre_result,
+                                   key_frame['bwd_flow_pre'].cuda())
+            warped_0 = flow_warp(first_result, key_frame['bwd_flow_0'].cuda())
+            blend_mask_pre = key_frame['blend_mask_pre'].cuda()
+            blend_mask_0 = key_frame['blend_mask_0'].cuda()
             blend_results = (1 - blend_mask_pre
                              ) * warped_pre + blend_mask_pre * direct_result
             blend_results = (
                 1 - blend_mask_0) * warped_0 + blend_mask_0 * blend_results
 
-            bwd_occ = 1 - torch.clamp(1 - bwd_occ_pre + 1 - bwd_occ_0, 0, 1)
-            blend_mask = blur(
-                F.max_pool2d(bwd_occ, kernel_size=9, stride=1, padding=4))
-            blend_mask = 1 - torch.clamp(blend_mask + bwd_occ, 0, 1)
-
             encoder_posterior = model.encode_first_stage(blend_results)
             xtrg = model.get_first_stage_encoding(
                 encoder_posterior).detach()  # * mask
@@ -517,13 +563,8 @@ def process2(*args):
                                   stride=1,
                                   padding=1)
 
-            mask = (1 - F.max_pool2d(1 - blend_mask, kernel_size=8)
-                    )  # * (1-mask_x)
-
-            if cfg.smooth_boundary:
-                noise_rescale = find_flat_region(mask)
-            else:
-                noise_rescale = torch.ones_like(mask)
+            mask = key_frame['mask'].cuda()  # * (1-mask_x)
+            noise_rescale = key_frame['noise_rescale'].cuda()
             masks = []
             for i in range(cfg.ddim_steps):
                 if i <= cfg.ddim_steps * cfg.mask_period[
@@ -561,10 +602,11 @@ def process2(*args):
                 strength=1 - cfg.x0_strength,
                 xtrg=xtrg,
                 mask=masks,
-                noise_rescale=noise_rescale)
+                noise_rescale=noise_rescale,
+                resume_from=intermediates.get('checkpoints',
+                                              {}).get(resume_step))
             x_samples = model.decode_first_stage(samples)
             pre_result = x_samples
-            pre_img = img
 
             viz = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 +
                    127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
@@ -705,6 +747,11 @@ with block:
                                        maximum=100,
                                        value=20,
                                        step=1)
+                solver = gr.Dropdown(
+                    SOLVERS,
+                    label='Solver',
+                    value='ddim',
+                    info='dpmpp_2m and unipc need fewer steps than ddim')
                 scale = gr.Slider(label='CFG scale',
                                   minimum=0.1,
                                   maximum=30.0,
@@ -850,7 +897,7 @@ with block:
                     x0_strength, use_constraints[0], cross_start, cross_end,
                     style_update_freq, warp_start, warp_end, mask_start,
                     mask_end, ada_start, ada_end, mask_strength,
-                    inner_strength, smooth_boundary
+                    inner_strength, smooth_boundary, solver
                 ]
 
                 gr.Examples(